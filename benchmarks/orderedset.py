@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" times OrderedSet add, iterate, discard, positional access and pickling, next to a plain set as reference
+
+usage: python benchmarks/orderedset.py [n]  (n defaults to 10**6; myobjects needs python 2)
+"""
+from __future__ import print_function
+import os
+import sys
+from timeit import default_timer
+from six.moves import cPickle as pickle, xrange
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from schlichtanders.myobjects import OrderedSet
+
+__author__ = 'Stephan Sahm <Stephan.Sahm@gmx.de>'
+
+
+def timed(name, func, *args):
+    start = default_timer()
+    ret = func(*args)
+    print("%-28s %8.3fs" % (name, default_timer() - start))
+    return ret
+
+
+def add_all(s, n):
+    for i in xrange(n):
+        s.add(i)
+    return s
+
+
+def iterate(s):
+    for _ in s:
+        pass
+
+
+def discard_every_other(s, n):
+    for i in xrange(0, n, 2):
+        s.discard(i)
+
+
+def index_some(s, k=1000):
+    step = max(len(s) // k, 1)
+    for i in xrange(0, len(s), step):
+        s[i]
+
+
+def roundtrip(s, protocol):
+    return pickle.loads(pickle.dumps(s, protocol))
+
+
+def main(n):
+    print("n = %i" % n)
+    for cls in (set, OrderedSet):
+        print(cls.__name__)
+        s = timed("  add", add_all, cls(), n)
+        timed("  iterate", iterate, s)
+        timed("  pickle (protocol 2)", roundtrip, s, 2)
+        if cls is OrderedSet:
+            timed("  index 1000 (no tombstones)", index_some, s)
+        timed("  discard every other", discard_every_other, s, n)
+        timed("  iterate half", iterate, s)
+        if cls is OrderedSet:
+            timed("  index 1000 (tombstones)", index_some, s)
+        timed("  pickle half (protocol 2)", roundtrip, s, 2)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10**6)
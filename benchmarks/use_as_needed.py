@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" per-call overhead of ``use_as_needed``, with its cached kwargs plan vs. inspecting the signature on every call
+
+usage: python benchmarks/use_as_needed.py [number of calls]  (defaults to 10**5)
+"""
+from __future__ import print_function
+import os
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from schlichtanders.myfunctools import _getfullargspec, use_as_needed
+
+__author__ = 'Stephan Sahm <Stephan.Sahm@gmx.de>'
+
+
+def use_as_needed_per_call(func, kwargs, args=tuple()):
+    """ former implementation of ``use_as_needed``, which inspected func on every call """
+    meta = _getfullargspec(func)
+    varkw = meta.varkw if hasattr(meta, 'varkw') else meta.keywords
+    if varkw is not None:
+        return func(*args, **kwargs)
+    return func(*args, **{k: kwargs[k] for k in kwargs if k in meta.args[len(args):]})
+
+
+def f(x, scale=1, offset=0):
+    return x * scale + offset
+
+
+def g(x, **kwargs):
+    return x
+
+
+class Model(object):
+    def predict(self, x, scale=1):
+        return x * scale
+
+
+def main(number):
+    kwargs = dict(scale=2, offset=1, unused=None)
+    model = Model()
+    cases = [
+        ("function", f),
+        ("function with **kwargs", g),
+        ("bound method", model.predict),
+    ]
+    print("%-24s %12s %12s %12s" % ("", "direct", "per call", "cached plan"))
+    for name, func in cases:
+        times = [
+            timeit(lambda: func(1, scale=2), number=number),
+            timeit(lambda: use_as_needed_per_call(func, kwargs, args=(1,)), number=number),
+            timeit(lambda: use_as_needed(func, kwargs, args=(1,)), number=number),
+        ]
+        print("%-24s %10.2fus %10.2fus %10.2fus" % ((name,) + tuple(t / number * 1e6 for t in times)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10**5)
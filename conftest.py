@@ -0,0 +1,6 @@
+# makes pytest put the repository root on sys.path, so that tests import the schlichtanders package from here
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 6):  # async generator syntax
+    collect_ignore.append("tests/test_myasyncio.py")
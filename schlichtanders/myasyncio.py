@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" asyncio support for ``myfunctools.fmap`` (python 3.6+ only).
+
+``fmap`` dispatches to the implementations here automatically: async generators are mapped lazily into new async
+generators, coroutines get awaited and coroutine functions are combined into new coroutine functions.
+Besides, ``gather_map`` maps a coroutine function concurrently over usual iterables, returning all results at once.
+``_concurrency`` limits the number of coroutines awaited at the same time.
+
+``compose_async`` and ``AsyncCompose`` are the counterparts of ``myfunctools.compose`` and ``Compose`` for pipelines
+with coroutine functions.
+"""
+import asyncio
+import inspect
+from collections import deque
+from functools import partial, wraps
+from schlichtanders.myfunctools import Compose, identity, kwargs_plan, use_as_needed
+
+__author__ = 'Stephan Sahm <Stephan.Sahm@gmx.de>'
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+async def _gather_limited(calls, concurrency=None):
+    """ awaits the results of all zero-argument ``calls`` concurrently, at most ``concurrency`` at once """
+    if not concurrency:
+        return await asyncio.gather(*(_maybe_await(call()) for call in calls))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(call):
+        async with semaphore:  # call only within the semaphore, as it may already start work
+            return await _maybe_await(call())
+    return await asyncio.gather(*(limited(call) for call in calls))
+
+
+def _split_values(values, n_args, keys):
+    return values[:n_args], dict(zip(keys, values[n_args:]))
+
+
+def fmap_async_iterable(func, *contexts, **kwargs_contexts):
+    """ fmap implementation to work with async iterables, returns an async generator
+
+    ``func`` may be a usual or a coroutine function. Results of the latter are awaited concurrently, with at most
+    ``_concurrency`` (default 1) in flight, while the order of outputs is kept. The contexts are consumed only as far
+    as needed for this, hence also infinite streams work.
+    """
+    if kwargs_contexts.pop('_inplace', False):
+        raise ValueError("Cannot fmap inplace on async iterables.")
+    concurrency = kwargs_contexts.pop('_concurrency', None) or 1
+    keys = list(kwargs_contexts)
+    iterators = [c.__aiter__() for c in contexts + tuple(kwargs_contexts[k] for k in keys)]
+
+    async def mapped():
+        pending = deque()  # futures of coroutine results or plain results, in order
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < concurrency:
+                    try:
+                        values = [await it.__anext__() for it in iterators]
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    args, kwargs = _split_values(values, len(contexts), keys)
+                    ret = func(*args, **kwargs)
+                    pending.append(asyncio.ensure_future(ret) if inspect.isawaitable(ret) else ret)
+                if not pending:
+                    return
+                ret = pending.popleft()
+                yield (await ret) if isinstance(ret, asyncio.Future) else ret
+        finally:  # e.g. if the consumer stops early
+            for ret in pending:
+                if isinstance(ret, asyncio.Future):
+                    ret.cancel()
+
+    return mapped()
+
+
+def fmap_coroutine(func, *contexts, **kwargs_contexts):
+    """ fmap implementation to work with coroutines, returns a coroutine
+
+    All contexts are awaited concurrently and ``func`` is called on their results (and awaited if needed).
+    """
+    if kwargs_contexts.pop('_inplace', False):
+        raise ValueError("Cannot fmap inplace on coroutines.")
+    concurrency = kwargs_contexts.pop('_concurrency', None)
+    keys = list(kwargs_contexts)
+    awaitables = contexts + tuple(kwargs_contexts[k] for k in keys)
+
+    async def mapped():
+        values = await _gather_limited([lambda a=a: a for a in awaitables], concurrency)
+        args, kwargs = _split_values(values, len(contexts), keys)
+        return await _maybe_await(func(*args, **kwargs))
+
+    return mapped()
+
+
+def fmap_coroutine_function(func, *contexts, **kwargs_contexts):
+    """ fmap implementation to work with functions of which some are coroutine functions
+
+    Like ``myfunctools.fmap_function``, only that the returned function is a coroutine function, awaiting the contexts'
+    results concurrently (at most ``_concurrency`` at once).
+    """
+    if kwargs_contexts.pop('_inplace', False):
+        raise ValueError("Cannot fmap inplace on functions.")
+    concurrency = kwargs_contexts.pop('_concurrency', None)
+    keys = list(kwargs_contexts)
+    all_contexts = contexts + tuple(kwargs_contexts[k] for k in keys)
+
+    @wraps(contexts[0] if contexts else all_contexts[0])
+    async def generic_func(*args, **kwargs):
+        values = await _gather_limited(
+            [lambda con=con: use_as_needed(con, kwargs, args=args) for con in all_contexts], concurrency)
+        args_, kwargs_ = _split_values(values, len(contexts), keys)
+        return await _maybe_await(func(*args_, **kwargs_))
+    generic_func.contexts = contexts
+    return generic_func
+
+
+async def gather_map(func, *contexts, **kwargs_contexts):
+    """ maps the (coroutine) function ``func`` over usual iterables concurrently, returning the list of all results
+
+    At most ``_concurrency`` (default unlimited) calls are awaited at once, e.g. to limit requests to a service.
+    """
+    concurrency = kwargs_contexts.pop('_concurrency', None)
+    keys = list(kwargs_contexts)
+    calls = []
+    for values in zip(*(contexts + tuple(kwargs_contexts[k] for k in keys))):
+        args, kwargs = _split_values(values, len(contexts), keys)
+        calls.append(lambda args=args, kwargs=kwargs: func(*args, **kwargs))
+    return await _gather_limited(calls, concurrency)
+
+
+def compose_async(*funcs, firstlatest=True, expand_tuple=True, executor=None):
+    """ like ``myfunctools.compose``, only that funcs may be coroutine functions and the result is a coroutine function
+
+    Results of stages which are awaitable are awaited, all other stages are called inline or, if ``executor`` is given,
+    on the executor (so that blocking functions do not block the event loop). As with ``compose``, each function gets
+    only those kwargs which it supports and tuple outputs are expanded as args of the next function.
+
+    Parameters
+    ----------
+    funcs : function
+        functions to be concatinated. By default (func1, func2, func3) -> func1(func2(func3(...))).
+    firstlatest : bool (default True)
+        if False (func1, func2, func3) -> func3(func2(func1(...)))
+    expand_tuple : bool (default True)
+        If True expand a return value of type tuple, so that next function is called like ``f(*tuple)``
+    executor : concurrent.futures.Executor
+        if given, functions which are no coroutine functions are run on it via ``loop.run_in_executor``
+
+    Returns
+    -------
+    concatinated functions as coroutine function
+    """
+    funcs = funcs[::-1] if firstlatest else funcs
+    funcs = [f for f in funcs if f != identity]
+    if not funcs:
+        funcs = [identity]
+    routes = []  # looked up lazily on the first call, like within compose
+
+    async def composed(*args, **kwargs):
+        if not routes:
+            routes[:] = [(f, kwargs_plan(f), inspect.iscoroutinefunction(f)) for f in funcs]
+        for f, plan, is_coroutine_function in routes:
+            if not (expand_tuple and isinstance(args, tuple)):  # i.e. only tuples are expanded as *args
+                args = (args,)
+            if plan is None:
+                f_kwargs = kwargs
+            else:
+                f_kwargs = {k: kwargs[k] for k in plan[len(args):] if k in kwargs}
+            if is_coroutine_function or executor is None:
+                args = f(*args, **f_kwargs)
+            else:
+                args = await asyncio.get_event_loop().run_in_executor(executor, partial(f, *args, **f_kwargs))
+            if inspect.isawaitable(args):  # also e.g. partials of coroutine functions
+                args = await args
+        return args
+
+    return composed
+
+
+class AsyncCompose(Compose):
+    """ like ``myfunctools.Compose``, only that funcs may be coroutine functions and calling returns a coroutine
+
+    See ``compose_async``. Like ``Compose`` it can be concatenated with ``+``, e.g.
+    >>> pipeline = AsyncCompose(executor=pool) + parse + fetch_async + validate
+    >>> result = await pipeline(request, timeout=10)
+    """
+    def __init__(self, *funcs, executor=None, **kwargs):
+        """
+        Parameters
+        ----------
+        funcs : functions
+            functions to be concatinated. (func1, func2, func3) -> func1(func2(func3(...))).
+        executor : concurrent.futures.Executor
+            if given, functions which are no coroutine functions are run on it
+        expand_tuple : bool (default True)
+            If True expand a return value of type tuple, so that next function is called like ``f(*tuple)``
+        """
+        if kwargs.get("cache") or kwargs.get("profile"):
+            raise ValueError("AsyncCompose supports neither cache nor profile")
+        super(AsyncCompose, self).__init__(*funcs, **kwargs)
+        self.executor = executor
+
+    def _options(self):
+        options = super(AsyncCompose, self)._options()
+        options['executor'] = self.executor
+        return options
+
+    def compile(self):
+        """ builds the composed coroutine function once, see ``myfunctools.Compose.compile`` """
+        if self._compiled is None:
+            self._compiled = compose_async(*self.funcs, expand_tuple=self.expand_tuple, executor=self.executor)
+        return self._compiled
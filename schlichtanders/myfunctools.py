@@ -3,12 +3,28 @@
 """ This module is one of my best modules. Enjoy. """
 
 from __future__ import division
+import hashlib
 import inspect
+import json
+import os
+import sys
+import threading
+import weakref
+from array import array
+from timeit import default_timer
 import numpy as np
-from types import FunctionType, GeneratorType
+from six import iteritems, itervalues
+from six.moves import cPickle, queue, reduce, xrange, zip as izip
+from types import CodeType, FunctionType, GeneratorType, MethodType, ModuleType
 from functools import wraps, partial
-from collections import Mapping, Sequence
-from itertools import izip, count
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:  # python 2
+    from collections import Mapping, Sequence
+from collections import OrderedDict, deque
+from itertools import count, islice
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from schlichtanders.mycontextmanagers import until_stopped
 
 __author__ = 'Stephan Sahm <Stephan.Sahm@gmx.de>'
@@ -19,11 +35,56 @@ general
 """
 
 
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda func: False)  # python 3.5+
+
+try:
+    _getfullargspec = inspect.getfullargspec
+except AttributeError:  # python 2, where only python functions can be inspected
+    def _getfullargspec(func):
+        if not isinstance(func, (FunctionType, MethodType)) and hasattr(func, '__call__'):  # callable objects
+            func = func.__call__
+        return inspect.getargspec(func)
+
+
+def _compute_kwargs_plan(func):
+    meta = _getfullargspec(func)
+    varkw = meta.varkw if hasattr(meta, 'varkw') else meta.keywords
+    return None if varkw is not None else tuple(meta.args)
+
+
+# id(func) --> (plan, weakref to func), keyed by id so that also unhashable callables can be cached
+# the weakref callback removes the entry as soon as func dies, i.e. before its id can be reused
+_kwargs_plans = {}
+
+
+def kwargs_plan(func):
+    """ precomputed "kwargs filter plan" for ``use_as_needed``, cached per callable
+
+    Returns
+    -------
+    None if func accepts arbitrary kwargs, else the tuple of its argument names
+    """
+    # bound methods are recreated on each attribute access, hence cache their underlying function
+    key = func.__func__ if isinstance(func, MethodType) else func
+    try:
+        return _kwargs_plans[id(key)][0]
+    except KeyError:
+        plan = _compute_kwargs_plan(func)
+        try:
+            ref = weakref.ref(key, lambda _, i=id(key): _kwargs_plans.pop(i, None))
+        except TypeError:  # not weak-referenceable, simply do not cache
+            return plan
+        _kwargs_plans[id(key)] = plan, ref
+        return plan
+
+
 def use_as_needed(func, kwargs, args=tuple()):
     """ calls the given function with the subset of kwargs which is supported by the function
 
     optionally you can also pass args
 
+    The function signature is inspected only once per callable, see ``kwargs_plan``.
+
     Parameters
     ----------
     func : function
@@ -35,12 +96,12 @@ def use_as_needed(func, kwargs, args=tuple()):
     -------
     returns the output of the function
     """
-    meta = inspect.getfullargspec(func)
-    if meta.varkw is not None:
-            return func(*args, **kwargs)
+    plan = kwargs_plan(func)
+    if plan is None:
+        return func(*args, **kwargs)
     else:
         # not generic super-constructor - pick only the relevant subentries:
-        return func(*args, **{k:kwargs[k] for k in kwargs if k in meta.args[len(args):]})
+        return func(*args, **{k: kwargs[k] for k in plan[len(args):] if k in kwargs})
 
 
 """
@@ -56,6 +117,10 @@ def convert(obj, type):
     (may converted to a subtype, e.g. for abstract types)
     if obj is already of type type, then it is directly returned
 
+    Which conversion of ``convertible`` to use is resolved once per (type(obj), type) by the mro of type(obj),
+    i.e. like for ``functools.singledispatch`` the conversion registered for the most specific class wins.
+    After changing ``convertible`` directly (instead of by ``register_conversion``), call ``convert.cache_clear()``.
+
     Parameters
     ----------
     obj : arbitrary
@@ -67,12 +132,48 @@ def convert(obj, type):
     -------
     converted object
     """
-    for (obj_type, conversion_type), conversion in convertible.iteritems():
-        if issubclass(conversion_type, type) and isinstance(obj, obj_type):
-            if not isinstance(obj, type):
-                return conversion(obj)
-            return obj
-    raise ValueError("cannot convert %s to type %s" % (obj, type))
+    key = obj.__class__, type
+    try:
+        conversion = _convert_cache[key]
+    except KeyError:
+        conversion = _convert_cache[key] = _resolve_conversion(*key)
+    if conversion is None:
+        raise ValueError("cannot convert %s to type %s" % (obj, type))
+    return conversion(obj)
+
+
+def _resolve_conversion(obj_class, type):
+    if issubclass(obj_class, type):
+        return keep_as_is
+    best, best_rank = None, None
+    for (obj_type, conversion_type), conversion in iteritems(convertible):
+        if issubclass(conversion_type, type) and issubclass(obj_class, obj_type):
+            rank = _mro_rank(obj_class, obj_type)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = conversion, rank
+    return best
+
+
+def _mro_rank(klass, base):
+    """ position of base within the mro of its subclass klass, i.e. the smaller the more specific """
+    mro = inspect.getmro(klass)
+    # abstract base classes are not part of the mro, rank them just before object
+    return mro.index(base) if base in mro else len(mro) - 1.5
+
+
+_convert_cache = {}  # (class of obj, type) --> conversion, None if not convertible
+convert.cache_clear = _convert_cache.clear
+
+
+def register_conversion(obj_type, conversion_type, conversion):
+    """ registers ``conversion`` for converting instances of ``obj_type`` to ``conversion_type`` (or supertypes) """
+    convertible[obj_type, conversion_type] = conversion
+    _convert_cache.clear()
+
+
+def keep_as_is(obj):
+    """ zero-copy conversion for objects which already support the interface of the target type """
+    return obj
 
 
 def convert_to_list(obj):
@@ -85,8 +186,12 @@ def convert_to_list(obj):
     return [obj]
 
 convertible = {
-    # should be sorted such that most general come first
-    (object, list): convert_to_list
+    # the conversion of the most specific obj type is used, see ``convert``
+    (object, list): convert_to_list,
+    # zero-copy: these already support len, indexing and iteration
+    (np.ndarray, Sequence): keep_as_is,
+    (memoryview, Sequence): keep_as_is,
+    (array, Sequence): keep_as_is,
 }
 
 
@@ -99,7 +204,7 @@ Still they fit well enough.
 """
 
 def fmap_singleton(f, *singleton_args):
-    args = map(lambda o: next(iter(o)), singleton_args)
+    args = [next(iter(o)) for o in singleton_args]
     return f(*args)
 
 
@@ -108,7 +213,7 @@ def summap(f, *batch_args):
 
     executes ``f`` on each list entry and returns summed up values
     """
-    batch_args = map(iter, batch_args)
+    batch_args = [iter(a) for a in batch_args]
     # initialize correctly:
     try:
         summed_up = f(*[next(a) for a in batch_args])  # [] are essential as StopIteration is not handled intuitively
@@ -125,7 +230,7 @@ def meanmap(f, *batch_args):
 
     executes ``f`` on each list entry and returns summed up values
     """
-    batch_args = map(iter, batch_args)
+    batch_args = [iter(a) for a in batch_args]
 
     # initialize correctly:
     try:
@@ -141,6 +246,233 @@ def meanmap(f, *batch_args):
     return summed_up/n
 
 
+class TreeSum(object):
+    """ accumulates values by pairwise (tree) summation, numerically more stable than summing up consecutively
+
+    Only O(log n) partial sums are kept, hence also long streams can be summed up. Partial sums of whole subtrees can
+    be added directly via ``add(value, n)``, where n is the number of original values summed up within ``value``.
+    """
+    def __init__(self):
+        self.partials = []  # [(n, partial sum)] with decreasing n
+        self.n = 0
+
+    def add(self, value, n=1):
+        self.n += n
+        while self.partials and self.partials[-1][0] <= n:
+            m, partial = self.partials.pop()
+            value = partial + value  # keep the order of summands
+            n += m
+        self.partials.append((n, value))
+
+    def result(self):
+        if not self.partials:
+            raise ValueError("empty args")
+        partials = iter(reversed(self.partials))
+        summed_up = next(partials)[1]
+        for _, partial in partials:
+            summed_up = partial + summed_up
+        return summed_up
+
+
+def _tree_sum_chunk(packed):
+    """ sums up ``f(*args)`` for a chunk of args, returning (n, sum) as chunks are further reduced by ``TreeSum`` """
+    f, chunk = packed
+    tree = TreeSum()
+    for args in chunk:
+        tree.add(f(*args))
+    return tree.n, tree.result()
+
+
+class ParallelSummap(object):
+    """ like ``summap``, only that ``f`` is evaluated in chunks on an executor and summed up by pairwise tree reduction
+
+    Works with ``concurrent.futures`` executors and ``multiprocessing`` pools alike (the latter require picklable
+    ``f``). Each chunk is summed up within the worker, so that only one partial sum per chunk is transferred back.
+    ``batch_args`` may be finite sequences or generators, of which only a bounded number of chunks is prefetched.
+    """
+    def __init__(self, executor=None, chunksize=1, prefetch=None):
+        """
+        Parameters
+        ----------
+        executor : concurrent.futures.Executor or multiprocessing.Pool
+            if None, everything is computed serially (still with tree reduction)
+        chunksize : int
+            number of batches evaluated per job, choose powers of two to get an exact pairwise reduction tree
+        prefetch : int
+            maximal number of chunks in flight, defaults to two per worker
+        """
+        self.executor = executor
+        self.chunksize = chunksize
+        self.prefetch = prefetch
+
+    def _summed_up(self, f, batch_args):
+        tree = TreeSum()
+        if self.executor is None:
+            for args in izip(*batch_args):
+                tree.add(f(*args))
+        else:
+            chunks = _parallel_chunks(_tree_sum_chunk, f, izip(*batch_args), self.executor,
+                                      self.chunksize, self.prefetch)
+            for n, partial in chunks:
+                tree.add(partial, n)
+        return tree
+
+    def __call__(self, f, *batch_args):
+        return self._summed_up(f, batch_args).result()
+
+
+class ParallelMeanmap(ParallelSummap):
+    """ like ``meanmap``, only parallelized with pairwise tree reduction as ``ParallelSummap`` """
+    def __call__(self, f, *batch_args):
+        tree = self._summed_up(f, batch_args)
+        return tree.result() / tree.n
+
+
+class RunningMean(object):
+    """ accumulates the mean of values (also elementwise for arrays) in constant memory """
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+
+    def add(self, value):
+        self.n += 1
+        if self.n == 1:
+            self.mean = value * 1.0  # copy, and no integer division later on
+        else:
+            self.mean = self.mean + (value - self.mean) / float(self.n)
+
+    def result(self):
+        if not self.n:
+            raise ValueError("empty args")
+        return self.mean
+
+
+class RunningVariance(RunningMean):
+    """ accumulates mean and variance of values (also elementwise for arrays) in constant memory (Welford's algorithm)
+
+    ``result`` returns the variance, the mean is available as attribute ``mean``.
+    """
+    def __init__(self, ddof=0):
+        super(RunningVariance, self).__init__()
+        self.ddof = ddof
+        self.m2 = 0.0  # sum of squared differences to the mean
+
+    def add(self, value):
+        old_mean = self.mean if self.n else value
+        super(RunningVariance, self).add(value)
+        self.m2 = self.m2 + (value - old_mean) * (value - self.mean)
+
+    def result(self):
+        if self.n <= self.ddof:
+            raise ValueError("not enough args for ddof=%s" % self.ddof)
+        return self.m2 / float(self.n - self.ddof)
+
+    @property
+    def std(self):
+        return np.sqrt(self.result())
+
+
+class RunningMinMax(object):
+    """ accumulates minimum and maximum of values (also elementwise for arrays) in constant memory
+
+    ``result`` returns the tuple (min, max).
+    """
+    def __init__(self):
+        self.n = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.n += 1
+        if self.n == 1:
+            self.min = self.max = value
+        else:
+            self.min = np.minimum(self.min, value)
+            self.max = np.maximum(self.max, value)
+
+    def result(self):
+        if not self.n:
+            raise ValueError("empty args")
+        return self.min, self.max
+
+
+class RunningLogSumExp(object):
+    """ accumulates log(sum(exp(values))) (also elementwise for arrays) in constant memory
+
+    Keeps a running maximum and the sum of exp(value - maximum), which is rescaled whenever the maximum increases.
+    Hence it is numerical stable like ``sumexp``. ``result`` returns log(sum(exp(values))),
+    ``result_mean`` log(1/n*sum(exp(values))).
+    """
+    def __init__(self):
+        self.n = 0
+        self.max = None
+        self.summed_exp = None
+
+    def add(self, value):
+        self.add_logsumexp(value)
+
+    def add_logsumexp(self, logsumexp, n=1):
+        """ adds n values at once, given their log(sum(exp(values))) """
+        self.n += n
+        if self.max is None:
+            self.max = logsumexp
+            self.summed_exp = np.ones_like(logsumexp, dtype=float)
+            return
+        new_max = np.maximum(self.max, logsumexp)
+        with np.errstate(invalid='ignore'):  # -inf - -inf, which is mapped to exp(0) by nan_to_num
+            self.summed_exp = (self.summed_exp * np.exp(np.nan_to_num(self.max - new_max))
+                               + np.exp(np.nan_to_num(logsumexp - new_max)))
+        self.max = new_max
+
+    def add_many(self, values):
+        """ adds all values (stacked along axis 0) at once, vectorized via ``sumexp`` """
+        values = convert(values, Sequence)
+        if len(values):
+            self.add_logsumexp(sumexp(values), len(values))
+
+    def result(self):
+        if not self.n:
+            raise ValueError("empty args")
+        return self.max + np.log(self.summed_exp)
+
+    def result_mean(self):
+        return self.result() - np.log(self.n)
+
+
+class Accumulate(object):
+    """ fmap feeding ``f(*args)`` for each entry of the ``batch_args`` into a fresh accumulator, returning its result
+
+    Accumulators are objects with methods ``add(value)`` and ``result()``, like ``RunningMean``, ``RunningVariance``,
+    ``RunningMinMax``, ``RunningLogSumExp`` or ``TreeSum``. As values are not collected, arbitrary long streams of
+    batch_args can be reduced in constant memory, e.g.
+    >>> f_var = lift(f, Accumulate(RunningVariance, ddof=1))
+    """
+    def __init__(self, accumulator=RunningMean, *args, **kwargs):
+        """ args and kwargs are passed to ``accumulator`` to construct a fresh one for each call """
+        self.accumulator = accumulator
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self, f, *batch_args):
+        accumulator = self.accumulator(*self.args, **self.kwargs)
+        for args in izip(*batch_args):
+            accumulator.add(f(*args))
+        return accumulator.result()
+
+
+varmap = Accumulate(RunningVariance)
+minmaxmap = Accumulate(RunningMinMax)
+
+
+class _OnlineState(object):
+    __slots__ = ('original_args', 'iterators', 'prefetched')
+
+    def __init__(self, original_args):
+        self.original_args = original_args
+        self.iterators = [iter(a) for a in original_args]
+        self.prefetched = None  # getter of the next args if prefetching
+
+
 class SimulateOnline(object):
     """ regards args as iterators where f is executed on each separately, consecutively"""
     @staticmethod
@@ -151,91 +483,266 @@ class SimulateOnline(object):
     def hash_by_hash(all_args):
         return hash(all_args)
 
-    def __init__(self, cycle=True, hash_by=lambda all_args: None):
+    def __init__(self, cycle=True, hash_by=lambda all_args: None, maxsize=None, prefetch=False):
         """ defaults to cycling and one unique hash
 
         if you want to reuse an SomulateOnline instance for several inputs,
         think about using ``SimulateOnline.hash_by_id`` or ``SimulateOnline.hash_by_hash``
         instead of the default ``hash_by``
+
+        Parameters
+        ----------
+        maxsize : int
+            maximal number of hash keys for which the iterator state is kept, the least recently used are evicted
+            (and start from the beginning again if used later on). Defaults to unbounded.
+        prefetch : bool
+            if True, the next args are fetched by a background thread while ``f`` runs on the current ones
         """
-        self.original_args = {}
-        self.iter_args = {}
+        self.states = OrderedDict()  # hash key --> _OnlineState, least recently used first
         self.cycle = cycle
         self.hash_by = hash_by
+        self.maxsize = maxsize
+        self.prefetch = prefetch
+        self._pool = None
 
-    def __call__(self, f, *all_args):
+    def _next_args(self, state):
+        try:
+            return [next(a) for a in state.iterators]
+        except StopIteration:
+            # if not infinite, reinitalize iterator
+            if not self.cycle:
+                raise
+            state.iterators = [iter(a) for a in state.original_args]
+            return [next(a) for a in state.iterators]
+
+    def _state(self, all_args):
         key = self.hash_by(all_args)
-        while True:  # for retrying
-            try:
-                return f(*[next(a) for a in self.iter_args[key]])
-            except StopIteration as e:
-                # if not infinite, reinitalize iterator
-                if self.cycle:
-                    self.iter_args[key] = map(iter, self.original_args[key])
-                else:
-                    raise e
-            except KeyError:
-                # fillvalue works both as empty args and empty kwargs
-                self.original_args[key] = all_args
-                self.iter_args[key] = map(iter, all_args)
+        state = self.states.pop(key, None)  # reinserted below to mark as most recently used
+        if state is None:
+            state = _OnlineState(all_args)
+        self.states[key] = state
+        if self.maxsize is not None and len(self.states) > self.maxsize:
+            self.states.popitem(last=False)
+        return state
+
+    def __call__(self, f, *all_args):
+        state = self._state(all_args)
+        if not self.prefetch:
+            return f(*self._next_args(state))
+        args = state.prefetched() if state.prefetched is not None else self._next_args(state)
+        if self._pool is None:
+            self._pool = ThreadPool(1)  # a single thread keeps the iterators' order
+        state.prefetched = _submit(self._pool, self._next_args, state)
+        return f(*args)
+
+
+def spawn_seeds(seed, n):
+    """ n independent seeds, derived reproducibly from ``seed`` (nondeterministically if None)
+
+    Uses ``numpy.random.SeedSequence`` where available (numpy >= 1.17), else draws them from a ``RandomState``.
+    """
+    if hasattr(np.random, 'SeedSequence'):
+        return [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(n)]
+    return [int(s) for s in np.random.RandomState(seed).randint(2**32, size=n, dtype=np.int64)]
+
+
+def _accepts_random_state(f):
+    try:
+        plan = kwargs_plan(f)
+    except TypeError:  # not inspectable
+        return False
+    return plan is not None and 'random_state' in plan
+
+
+def _is_thread_executor(executor):
+    if isinstance(executor, ThreadPool):
+        return True
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:  # python 2 without the futures backport
+        return False
+    return isinstance(executor, ThreadPoolExecutor)
+
+
+def _seeded_call(f, seed, args, kwargs):
+    """ calls f with its own random stream
+
+    If f has an argument ``random_state``, a fresh ``numpy.random.RandomState(seed)`` is passed. Else numpy's global
+    random state is seeded for the call and restored afterwards. As the global state is shared by all threads of a
+    process, the latter gives independent streams only if calls do not run concurrently within one process.
+    """
+    if _accepts_random_state(f):
+        return f(*args, **dict(kwargs, random_state=np.random.RandomState(seed)))
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return f(*args, **kwargs)
+    finally:
+        np.random.set_state(state)
 
 
 class Average(object):
     """ computes result several times and returns averages of all """
-    def __init__(self, repeat_n_times=1):
+    def __init__(self, repeat_n_times=1, executor=None, seed=None, target_rse=None, min_n_times=3):
+        """
+        Parameters
+        ----------
+        repeat_n_times : int
+            number of repetitions, maximal number if ``target_rse`` is given
+        executor : concurrent.futures.Executor or multiprocessing.Pool
+            if given, repetitions are computed concurrently on it (process pools require picklable f)
+        seed : int
+            if given (or if an executor is given), each repetition gets its own random stream derived from ``seed``,
+            see ``spawn_seeds`` and ``_seeded_call``. This makes results reproducible, serially and on process pools
+            alike. For seeded repetitions on thread executors f must have an argument ``random_state`` (and use only
+            it), as numpy's global random state is shared among threads. Without seed, f is called as is on them.
+        target_rse : float
+            if given, repetitions stop early as soon as the relative standard error of the mean, i.e.
+            std/sqrt(n)/abs(mean), is at most ``target_rse`` (for arrays in all entries). The number of repetitions
+            actually used is stored in ``last_n_times``.
+        min_n_times : int
+            minimal number of repetitions before stopping early, as the variance estimate is unreliable before
+        """
         self.repeat_n_times = repeat_n_times
+        self.executor = executor
+        self.seed = seed
+        self.target_rse = target_rse
+        self.min_n_times = min_n_times
+        self.last_n_times = None
+
+    def __getstate__(self):  # last_n_times is no configuration, e.g. it must not change ``content_digest(self)``
+        state = self.__dict__.copy()
+        state['last_n_times'] = None
+        return state
+
+    def _repetitions(self, f, args, kwargs):
+        """ lazily yields the results of all repetitions in order """
+        if self.executor is None and self.seed is None:
+            return (f(*args, **kwargs) for _ in xrange(self.repeat_n_times))
+        if _is_thread_executor(self.executor) and not _accepts_random_state(f):
+            if self.seed is not None:
+                raise ValueError("f needs an argument random_state for seeded repetitions on thread executors")
+            # nothing to make reproducible, and seeding the shared global random state would only interfere
+            return _parallel_imap(f, [(args, kwargs)] * self.repeat_n_times, self.executor)
+        calls = [((f, seed, args, kwargs), {}) for seed in spawn_seeds(self.seed, self.repeat_n_times)]
+        if self.executor is None:
+            return (_seeded_call(*call) for call, _ in calls)
+        return _parallel_imap(_seeded_call, calls, self.executor)
 
     def __call__(self, f, *args, **kwargs):
-        if self.repeat_n_times == 1:  # usually standard case, therefore make it a bit faster
+        if self.repeat_n_times == 1 and self.seed is None:  # usually standard case, therefore make it a bit faster
             return f(*args, **kwargs)
         # else, i.e. repeat_n_times > 1:
-        summed_up = f(*args, **kwargs)
-        for _ in xrange(self.repeat_n_times - 1):
-            summed_up += f(*args, **kwargs)
+        repetitions = self._repetitions(f, args, kwargs)
+        if self.target_rse is not None:
+            return self._adaptive_mean(repetitions)
+        summed_up = next(repetitions)
+        for r in repetitions:
+            summed_up += r
+        self.last_n_times = self.repeat_n_times
         return summed_up / self.repeat_n_times
 
+    def _adaptive_mean(self, repetitions):
+        running = RunningVariance(ddof=1)
+        for r in repetitions:
+            running.add(r)
+            if (running.n >= max(self.min_n_times, 2) and  # without division, as the mean may be 0
+                    np.all(np.sqrt(running.result() / running.n) <= self.target_rse * np.abs(running.mean))):
+                break
+        self.last_n_times = running.n
+        return running.mean
+
+
+def _stack(values):
+    """ returns values as single numeric ndarray (stacked along axis 0), or None if this is not possible """
+    try:
+        stacked = np.asarray(values)
+    except ValueError:  # e.g. arrays of different shapes
+        return None
+    return None if stacked.dtype == object else stacked
+
+
+def _sumexp_stacked(values, axis):
+    largest = values.max(axis=axis, keepdims=True)
+    largest[~np.isfinite(largest)] = 0  # all -inf (or inf) would result in nan otherwise
+    # floats keep their precision, everything else (ints, bools) is computed in float64
+    dtype = values.dtype if np.issubdtype(values.dtype, np.inexact) else np.result_type(values.dtype, np.float64)
+    buffer = np.subtract(values, largest, dtype=dtype)
+    np.exp(buffer, out=buffer)
+    with np.errstate(divide='ignore'):  # log(0) = -inf is fine
+        return np.squeeze(largest, axis=axis) + np.log(buffer.sum(axis=axis))
 
-def sumexp(values):
+
+def sumexp(values, axis=0):
+    """ numerical stable version of log(sum(exp(values))) along ``axis``
+
+    ``values`` may be an ndarray or a sequence of equally shaped values, which get stacked along axis 0 (the default
+    axis) and are reduced by a few vectorized calls. Other sequences (e.g. of differently shaped arrays or symbolic
+    variables) are reduced elementwise, i.e. along axis 0 only.
+
+    Raises
+    ------
+    ValueError if values cannot be stacked and axis is not 0
+    """
     values = convert(values, Sequence)
+    stacked = _stack(values)
+    if stacked is not None:
+        return _sumexp_stacked(stacked, axis)
+    if axis != 0:
+        raise ValueError("values which cannot be stacked are reduced along axis 0 only, got axis=%r" % axis)
     largest = reduce(np.maximum, values)
     return largest + np.log(sum(np.exp(r - largest) for r in values))
 
 
-def meanexp(values):
+def meanexp(values, axis=0):
+    """ numerical stable version of log(1/n*sum(exp(values))) along ``axis``, see ``sumexp`` """
     values = convert(values, Sequence)
-    return sumexp(values) - np.log(len(values))
+    stacked = _stack(values)
+    if stacked is not None:
+        return _sumexp_stacked(stacked, axis) - np.log(stacked.shape[axis])
+    return sumexp(values, axis) - np.log(len(values))
+
+
+def _accumulate_logsumexp(f, batch_args, chunksize=1024):
+    """ streams ``f(*args)`` in chunks through the vectorized ``sumexp`` into a ``RunningLogSumExp`` """
+    accumulator = RunningLogSumExp()
+    calls = izip(*batch_args)
+    while True:
+        chunk = [f(*args) for args in islice(calls, chunksize)]
+        if not chunk:
+            return accumulator
+        accumulator.add_many(chunk)
 
 
 def sumexpmap(f, *batch_args):
-    """ numerical stable version of log(sum(exp(...)) """
-    values = [f(*args) for args in izip(*batch_args)]
-    return sumexp(values)
+    """ numerical stable version of log(sum(exp(...)), streaming in constant memory """
+    return _accumulate_logsumexp(f, batch_args).result()
+
 
 def meanexpmap(f, *batch_args):
-    """ numerical stable version of log(1/n*sum(exp(...)) """
-    values = [f(*args) for args in izip(*batch_args)]
-    return meanexp(values)
+    """ numerical stable version of log(1/n*sum(exp(...)), streaming in constant memory """
+    return _accumulate_logsumexp(f, batch_args).result_mean()
 
 
-class AverageExp(object):
+class AverageExp(Average):
     """ like average, only that the average is computed on exponential scale
 
     log(Average(exp(x)))"""
-    def __init__(self, repeat_n_times=1, numerical_stable=True):
-        self.repeat_n_times = repeat_n_times
+    def __init__(self, repeat_n_times=1, numerical_stable=True, executor=None, seed=None):
+        super(AverageExp, self).__init__(repeat_n_times, executor=executor, seed=seed)
         self.numerical_stable = numerical_stable
 
     def __call__(self, f, *args, **kwargs):
-        if self.repeat_n_times == 1:  # usually standard case, therefore make it a bit faster
+        if self.repeat_n_times == 1 and self.seed is None:  # usually standard case, therefore make it a bit faster
             return f(*args, **kwargs)
         # else, i.e. repeat_n_times > 1:
+        repetitions = self._repetitions(f, args, kwargs)
         if self.numerical_stable:
-            repetitions = [f(*args, **kwargs) for _ in xrange(self.repeat_n_times)]
-            return meanexp(repetitions)
+            return meanexp(list(repetitions))
         else:
-            summed_up = np.exp(f(*args, **kwargs))
-            for _ in xrange(self.repeat_n_times - 1):
-                summed_up += np.exp(f(*args, **kwargs))
+            summed_up = np.exp(next(repetitions))
+            for r in repetitions:
+                summed_up += np.exp(r)
             return np.log(summed_up) - np.log(self.repeat_n_times)
 
 
@@ -256,6 +763,9 @@ def fmap(func, *contexts, **kwargs_contexts):
     Support for lists, generators, tuples (everything map supports), functions,
     and generally classes which implement "__map__" are listed in ``fmappable``.
 
+    The implementation is resolved once per tuple of context types and cached. Use ``register_fmap`` to support
+    further types, after changing ``fmappable`` directly call ``fmap.cache_clear()``.
+
     Parameters
     ----------
     func : function
@@ -267,22 +777,45 @@ def fmap(func, *contexts, **kwargs_contexts):
     _inplace : bool, defaults to False
         kwarg which will be popped from func_kwargs, indicating whether the function shall be mapped in place (if possible)
         Note, that for this func must return the same number of outputs as contexts
+    _executor : executor or pool, optional
+        kwarg which will be popped from func_kwargs. If given, lists, dicts and generators are mapped concurrently on it.
+        Anything with ``submit`` (``concurrent.futures``) or ``apply_async`` (``multiprocessing`` pools) works.
+        For process pools func has to be picklable.
+    _chunksize : int, optional
+        kwarg which will be popped from func_kwargs, chunksize for implementations which work in chunks
+        (e.g. ``fmap_ndarray`` for scalar functions, or each job of the ``_executor``)
+    _concurrency : int, optional
+        kwarg which will be popped from func_kwargs, maximal number of coroutines awaited at once for async contexts
+        (see ``myasyncio``, python 3.6+)
+    _lazy : bool, defaults to False
+        kwarg which will be popped from func_kwargs. If True, the (iterable) contexts are not mapped directly, but a
+        deferred ``Lazy`` expression is returned, which fuses further fmaps into one pass (fmaps over ``Lazy``
+        contexts are always deferred)
 
     Returns
     -------
     mapped result
     """
     inplace = kwargs_contexts.pop('_inplace', False)
-    if len(contexts) == 1 and len(kwargs_contexts) == 0 and hasattr(contexts[0], '__map__'):
-        return contexts[0].__map__(func, inplace=inplace)
+    if kwargs_contexts.pop('_lazy', False):
+        return fmap_lazy(func, *contexts, _inplace=inplace, **kwargs_contexts)
+    options = {k: kwargs_contexts.pop(k) for k in FMAP_OPTIONS if k in kwargs_contexts}
+    key = (tuple([con.__class__ for con in contexts]),
+           tuple([con.__class__ for con in itervalues(kwargs_contexts)]) if kwargs_contexts else ())
+    try:
+        fmap_impl = _fmap_cache[key]
+    except KeyError:
+        fmap_impl = _fmap_cache[key] = _resolve_fmap(*key)
 
-    for klass in fmappable:
-        if all(isinstance(con, klass) for con in contexts + tuple(kwargs_contexts.itervalues())):
-            ret = fmappable[klass](func, *contexts, _inplace=inplace, **kwargs_contexts)
-            if inplace:
-                return contexts[0] if len(contexts) == 1 else None
-            else:
-                return ret
+    if fmap_impl is _fmap_by_map_method:
+        return contexts[0].__map__(func, inplace=inplace)
+    elif fmap_impl is not None:
+        kwargs_contexts.update(options)  # passed on only if given
+        ret = fmap_impl(func, *contexts, _inplace=inplace, **kwargs_contexts)
+        if inplace:
+            return contexts[0] if len(contexts) == 1 else None
+        else:
+            return ret
     else:
         # final default: just apply function to values, this makes fmap interface very easy, but also probably difficult to debug
         if inplace:
@@ -290,15 +823,56 @@ def fmap(func, *contexts, **kwargs_contexts):
         return func(*contexts)
 
 
+FMAP_OPTIONS = ('_chunksize', '_executor', '_concurrency')  # popped by fmap, passed on to the implementation
+
+
+def _fmap_by_map_method(func, context, _inplace=False):
+    return context.__map__(func, inplace=_inplace)
+
+
+def _resolve_fmap(context_classes, kwargs_context_classes):
+    """ fmap implementation for contexts of the given classes, None if there is none """
+    if len(context_classes) == 1 and not kwargs_context_classes and hasattr(context_classes[0], '__map__'):
+        return _fmap_by_map_method
+    if any(issubclass(c, Lazy) for c in context_classes + kwargs_context_classes):
+        return fmap_lazy  # even if mixed with other iterables, which become lazy sources
+    classes = context_classes + kwargs_context_classes
+    best, best_rank = None, None
+    for klass, fmap_impl in iteritems(fmappable):  # the most specific registration wins, like for ``convert``
+        if all(issubclass(c, klass) for c in classes):
+            rank = max(_mro_rank(c, klass) for c in classes)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = fmap_impl, rank
+    return best
+
+
+def register_fmap(klass, fmap_impl):
+    """ registers ``fmap_impl`` for contexts of type ``klass``
+
+    Like for ``convert``, the implementation registered for the most specific class wins, e.g. one registered for
+    ``OrderedDict`` is used instead of ``fmap_dict`` for ``OrderedDict`` contexts.
+
+    ``fmap_impl`` is called like ``fmap_impl(func, *contexts, _inplace=False, **kwargs_contexts)``
+    """
+    fmappable[klass] = fmap_impl
+    _fmap_cache.clear()
+
+
 def fmap_function(func, *contexts, **kwargs_contexts):
     """ fmap implementation to work with functions """
     if kwargs_contexts.pop('_inplace', False):
         raise ValueError("Cannot fmap inplace on functions.")
+    kwargs_contexts.pop('_executor', None)  # nothing to parallelize here
+    kwargs_contexts.pop('_chunksize', None)
+    concurrency = kwargs_contexts.pop('_concurrency', None)
+    if any(_iscoroutinefunction(con) for con in contexts + tuple(itervalues(kwargs_contexts))):
+        from schlichtanders.myasyncio import fmap_coroutine_function
+        return fmap_coroutine_function(func, *contexts, _concurrency=concurrency, **kwargs_contexts)
 
     @wraps(contexts[0])  # TODO improve this? by combining signatures - similar to compose
     def generic_func(*args, **kwargs):
         return func(*(use_as_needed(con, kwargs, args=args) for con in contexts),
-                    **{k: use_as_needed(con, kwargs, args=args) for k, con in kwargs_contexts})
+                    **{k: use_as_needed(con, kwargs, args=args) for k, con in iteritems(kwargs_contexts)})
     generic_func.contexts = contexts
     return generic_func
 
@@ -308,30 +882,56 @@ def fmap_dict(func, *contexts, **kwargs_contexts):
 
     inplace only affects *contexts"""
     inplace = kwargs_contexts.pop('_inplace', False)
+    executor = kwargs_contexts.pop('_executor', None)
+    chunksize = kwargs_contexts.pop('_chunksize', None)
     newdict = {}
-    for key in contexts[0].keys():
-        try:
-            newdict[key] = func(*(con[key] for con in contexts),
-                                **{k: con[key] for k, con in kwargs_contexts})
-        except KeyError:
-            continue
+    if executor is not None:
+        all_contexts = contexts + tuple(itervalues(kwargs_contexts))
+        keys = [key for key in contexts[0].keys() if all(key in con for con in all_contexts)]
+        calls = (([con[key] for con in contexts], {k: con[key] for k, con in iteritems(kwargs_contexts)})
+                 for key in keys)
+        newdict.update(izip(keys, _parallel_imap(func, calls, executor, chunksize)))
+    else:
+        for key in contexts[0].keys():
+            try:
+                newdict[key] = func(*(con[key] for con in contexts),
+                                    **{k: con[key] for k, con in iteritems(kwargs_contexts)})
+            except KeyError:
+                continue
     if not inplace:
         return newdict
     else:
-        for k, vs in newdict.iteritems():
+        for k, vs in iteritems(newdict):
             for c, v in izip(contexts, vs):
                 c[k] = v
 
 
 def fmap_iterable(func, *contexts, **kwargs_contexts):
-    """ inplace works only for Mutable types and will effect only contexts """
+    """ inplace works only for Mutable types and will effect only contexts
+
+    With ``_executor``, chunks of ``_chunksize`` elements are computed concurrently, however only a bounded number of
+    chunks is in flight at any time, so that also infinite generators can be mapped lazily. """
     inplace = kwargs_contexts.pop('_inplace', False)
+    executor = kwargs_contexts.pop('_executor', None)
+    chunksize = kwargs_contexts.pop('_chunksize', None)
+    if executor is not None:
+        keys = list(kwargs_contexts.keys())
+        calls = ((values[:len(contexts)], dict(izip(keys, values[len(contexts):])))
+                 for values in izip(*(contexts + tuple(kwargs_contexts[k] for k in keys))))
+        for i, ret in enumerate(_parallel_imap(func, calls, executor, chunksize)):
+            if not inplace:
+                yield ret
+            else:
+                for c, r in izip(contexts, ret):
+                    c[i] = r
+        return
+
     iter_contexts = [iter(c) for c in contexts]
-    kwargs_iter_contexts = {k: iter(c) for k, c in kwargs_contexts.iteritems()}
+    kwargs_iter_contexts = {k: iter(c) for k, c in iteritems(kwargs_contexts)}
     try:
         for i in count(0):
-            ret = func(*(next(con) for con in iter_contexts),
-                       **{k: next(con) for k, con in kwargs_iter_contexts.iteritems()})
+            ret = func(*[next(con) for con in iter_contexts],  # [] are essential, see summap
+                       **{k: next(con) for k, con in iteritems(kwargs_iter_contexts)})
             if not inplace:
                 yield ret
             else:
@@ -341,19 +941,276 @@ def fmap_iterable(func, *contexts, **kwargs_contexts):
         pass
 
 
+def _call_chunk(packed):
+    """ calls func on a chunk of (args, kwargs), packed into one tuple as executors map over single arguments """
+    func, calls = packed
+    return [func(*args, **kwargs) for args, kwargs in calls]
+
+
+def _submit(executor, func, arg):
+    """ submits to concurrent.futures executors or multiprocessing pools alike, returning a getter for the result """
+    if hasattr(executor, 'submit'):
+        return executor.submit(func, arg).result
+    return executor.apply_async(func, (arg,)).get
+
+
+def _parallel_chunks(chunk_func, func, calls, executor, chunksize=None, prefetch=None):
+    """ lazily yields ``chunk_func((func, chunk))`` for consecutive chunks of ``calls`` in order, computed on ``executor``
+
+    At most ``prefetch`` (default two per worker) chunks are in flight, i.e. ``calls`` is only consumed as far as needed.
+    """
+    chunksize = chunksize or 1
+    if prefetch is None:
+        prefetch = 2 * (getattr(executor, '_processes', None) or getattr(executor, '_max_workers', None) or cpu_count())
+    calls = iter(calls)
+    pending = deque()
+    while True:
+        while len(pending) < prefetch:
+            chunk = list(islice(calls, chunksize))
+            if not chunk:
+                break
+            pending.append(_submit(executor, chunk_func, (func, chunk)))
+        if not pending:
+            return
+        yield pending.popleft()()
+
+
+def _parallel_imap(func, calls, executor, chunksize=None):
+    """ lazily yields ``func(*args, **kwargs)`` for each (args, kwargs) in order, computed in chunks on ``executor`` """
+    for rets in _parallel_chunks(_call_chunk, func, calls, executor, chunksize):
+        for ret in rets:
+            yield ret
+
+
 def fmap_list(func, *contexts, **kwargs_contexts):
     """ fmap implementation to work with lists (more general Sequence) """
     ret = list(fmap_iterable(func, *contexts, **kwargs_contexts))
     return ret if ret else None  # list of empty generator is [] not None
 
 
+def vectorized(func):
+    """ marks ``func`` to work elementwise on whole arrays, so that ``fmap`` calls it only once on ndarrays """
+    func.vectorized = True
+    return func
+
+
+def scalar(func):
+    """ marks ``func`` to work on scalars only, so that ``fmap`` applies it elementwise on ndarrays """
+    func.vectorized = False
+    return func
+
+
+def fmap_ndarray(func, *contexts, **kwargs_contexts):
+    """ fmap implementation to work with numpy arrays, all contexts are broadcasted together
+
+    ufuncs, ``np.vectorize`` and functions marked by ``vectorized`` are called once on the whole arrays (ufuncs write
+    directly into the contexts if inplace). Functions marked by ``scalar`` are applied elementwise, in chunks of
+    ``_chunksize`` elements. Unmarked functions are tried on the whole arrays first and applied elementwise only if this
+    raises a TypeError or ValueError.
+
+    inplace writes the output into the first context (or a tuple of outputs into the respective contexts)
+    """
+    inplace = kwargs_contexts.pop('_inplace', False)
+    chunksize = kwargs_contexts.pop('_chunksize', None) or 4096
+    kwargs_contexts.pop('_executor', None)  # vectorized anyway
+
+    if isinstance(func, np.ufunc):
+        if inplace:
+            return func(*contexts, out=contexts[0] if func.nout == 1 else contexts[:func.nout])
+        return func(*contexts)
+
+    is_vectorized = isinstance(func, np.vectorize) or getattr(func, 'vectorized', None)
+    if is_vectorized is not False:  # i.e. vectorized or unknown
+        try:
+            ret = func(*contexts, **kwargs_contexts)
+        except (TypeError, ValueError):
+            if is_vectorized:
+                raise
+        else:
+            if inplace:
+                _assign_outputs(contexts, ret)
+            return ret
+
+    # final fallback: scalar function
+    return _fmap_ndarray_elementwise(func, contexts, kwargs_contexts, inplace, chunksize)
+
+
+def _assign_outputs(contexts, ret):
+    if len(contexts) == 1:
+        contexts[0][...] = ret
+    else:
+        for c, r in izip(contexts, ret):
+            c[...] = r
+
+
+def _fmap_ndarray_elementwise(func, contexts, kwargs_contexts, inplace, chunksize):
+    keys = list(kwargs_contexts.keys())
+    broadcasted = np.broadcast_arrays(*(contexts + tuple(kwargs_contexts[k] for k in keys)))
+    shape = broadcasted[0].shape if broadcasted else ()
+    n = broadcasted[0].size if broadcasted else 0
+    flats = [b.flat for b in broadcasted]
+    n_args = len(contexts)
+    outs = None  # one array per output, allocated after the first results, as only then dtypes are known
+    for start in xrange(0, n, chunksize):
+        chunks = [f[start:start + chunksize].tolist() for f in flats]  # flat slices copy only a chunk
+        if keys:
+            outputs = [func(*values[:n_args], **dict(izip(keys, values[n_args:]))) for values in izip(*chunks)]
+        else:
+            outputs = list(map(func, *chunks))
+        if inplace:
+            if len(contexts) == 1:
+                contexts[0].flat[start:start + chunksize] = outputs
+            else:
+                for c, o in izip(contexts, izip(*outputs)):
+                    c.flat[start:start + chunksize] = o
+        else:
+            multiple = isinstance(outputs[0], tuple)  # like ufuncs with several outputs, return a tuple of arrays
+            chunk_outs = [np.asarray(o) for o in izip(*outputs)] if multiple else [np.asarray(outputs)]
+            if outs is None:
+                outs = [np.empty(shape, dtype=o.dtype) for o in chunk_outs]
+            for i, (out, o) in enumerate(izip(outs, chunk_outs)):
+                dtype = np.promote_types(out.dtype, o.dtype)
+                if dtype != out.dtype:  # e.g. later chunks have floats while the first had only ints
+                    outs[i] = out = out.astype(dtype)
+                out.flat[start:start + chunksize] = o
+    if inplace:
+        return None
+    if outs is None:  # empty arrays
+        return np.empty(shape)
+    return tuple(outs) if multiple else outs[0]
+
+
+class Lazy(object):
+    """ deferred fmap expression over iterables, evaluated in a single pass on ``compute()`` or iteration
+
+    Create sources with ``lazy(iterable)`` (or use ``fmap(..., _lazy=True)``), then every fmap over Lazy contexts
+    returns a new deferred node instead of computing anything, e.g.
+    >>> xs = lazy(range(10))
+    >>> ys = fmap(g, fmap(f, xs), xs)
+    >>> ys.compute()  # like [g(f(x), x) for x in range(10)]
+
+    On evaluation all nodes are computed element by element: chains of fmaps are fused into one pass without any
+    intermediate lists and nodes used several times (also equal ones, i.e. the same function on the same parents) are
+    computed only once per element. Sources are iterated anew on each evaluation, hence generators can be evaluated
+    only once. Several nodes can be evaluated together in one pass by ``evaluate_lazy``.
+    """
+    def __init__(self, func=None, args=(), kwargs=None, source=None):
+        self.func = func  # None for sources
+        self.args = args  # parent Lazy nodes
+        self.kwargs = kwargs or {}
+        self.source = source
+
+    def __iter__(self):
+        for values in evaluate_lazy(self):
+            yield values[0]
+
+    def compute(self):
+        return list(self)
+
+    def __repr__(self):
+        if self.func is None:
+            return "lazy(%r)" % (self.source,)
+        return "Lazy(%s, %i parents)" % (getattr(self.func, '__name__', self.func), len(self.args) + len(self.kwargs))
+
+
+def lazy(iterable):
+    """ source node of a deferred fmap expression, see ``Lazy`` """
+    return iterable if isinstance(iterable, Lazy) else Lazy(source=iterable)
+
+
+def fmap_lazy(func, *contexts, **kwargs_contexts):
+    """ fmap implementation to work with ``Lazy`` contexts, other contexts are regarded as further lazy sources """
+    if kwargs_contexts.pop('_inplace', False):
+        raise ValueError("Cannot fmap inplace on lazy expressions.")
+    for option in FMAP_OPTIONS:
+        kwargs_contexts.pop(option, None)
+    return Lazy(func, tuple(lazy(c) for c in contexts), {k: lazy(c) for k, c in iteritems(kwargs_contexts)})
+
+
+def _compile_lazy(nodes):
+    """ returns source iterables, steps [(func, arg positions, kwarg positions)] and output positions
+
+    Positions refer to the values of one element, which are the source values followed by the step results.
+    """
+    sources = []
+    steps = []
+    positions = {}  # id(node) or structural key --> ('source', i) or ('step', j)
+
+    def visit(node):
+        try:
+            return positions[id(node)]
+        except KeyError:
+            pass
+        if node.func is None:
+            key = ('source', id(node.source))
+            if key not in positions:
+                positions[key] = 'source', len(sources)
+                sources.append(node.source)
+        else:
+            args = tuple(visit(a) for a in node.args)
+            kwargs = tuple(sorted((k, visit(a)) for k, a in iteritems(node.kwargs)))
+            key = (node.func, args, kwargs)
+            try:
+                hash(key)
+            except TypeError:  # unhashable func, can only be shared by identity
+                key = id(node)
+            if key not in positions:
+                positions[key] = 'step', len(steps)
+                steps.append((node.func, args, kwargs))
+        positions[id(node)] = positions[key]
+        return positions[key]
+
+    outputs = [visit(node) for node in nodes]
+
+    def resolve(position):
+        kind, i = position
+        return i if kind == 'source' else len(sources) + i
+    steps = [(func, [resolve(a) for a in args], [(k, resolve(a)) for k, a in kwargs]) for func, args, kwargs in steps]
+    return sources, steps, [resolve(o) for o in outputs]
+
+
+def evaluate_lazy(*nodes):
+    """ evaluates all ``Lazy`` nodes together in a single pass, yielding a tuple of their values per element """
+    sources, steps, outputs = _compile_lazy(nodes)
+    for values in izip(*sources):
+        values = list(values)
+        for func, args, kwargs in steps:
+            if kwargs:
+                values.append(func(*[values[i] for i in args], **{k: values[i] for k, i in kwargs}))
+            else:
+                values.append(func(*[values[i] for i in args]))
+        yield tuple([values[i] for i in outputs])
+
+
 fmappable = {
     FunctionType: fmap_function,
     Mapping: fmap_dict,
     GeneratorType: fmap_iterable,
     Sequence: fmap_list,
+    np.ndarray: fmap_ndarray,
 }
 
+try:  # python 3.6+
+    from types import AsyncGeneratorType, CoroutineType
+except ImportError:
+    pass
+else:
+    def fmap_async_iterable(func, *contexts, **kwargs_contexts):
+        """ fmap implementation to work with async generators, see ``myasyncio.fmap_async_iterable`` """
+        from schlichtanders.myasyncio import fmap_async_iterable
+        return fmap_async_iterable(func, *contexts, **kwargs_contexts)
+
+    def fmap_coroutine(func, *contexts, **kwargs_contexts):
+        """ fmap implementation to work with coroutines, see ``myasyncio.fmap_coroutine`` """
+        from schlichtanders.myasyncio import fmap_coroutine
+        return fmap_coroutine(func, *contexts, **kwargs_contexts)
+
+    fmappable[AsyncGeneratorType] = fmap_async_iterable
+    fmappable[CoroutineType] = fmap_coroutine
+
+_fmap_cache = {}  # (context classes, kwargs context classes) --> fmap implementation, None for default
+fmap.cache_clear = _fmap_cache.clear
+
 
 def lift(f, *fmaps):
     """ will transform func to a new function with the fmaps applied like function composition
@@ -403,6 +1260,300 @@ def as_wrapper(*fmaps, **kwargs):
 
 decorator_from_fmap = as_wrapper
 
+"""
+caching
+-------
+"""
+
+
+def content_key(obj):
+    """ hashable key representing the content of obj, also for unhashable ndarrays, lists, dicts and sets
+
+    ndarrays are represented by dtype, shape and a sha1 digest of their data.
+
+    Raises
+    ------
+    TypeError if obj (or some part of it) is neither hashable nor one of the above
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return np.ndarray, obj.shape, content_key(obj.tolist())
+        return np.ndarray, obj.dtype.str, obj.shape, hashlib.sha1(np.ascontiguousarray(obj)).hexdigest()
+    if isinstance(obj, (list, tuple)):
+        entries = tuple(obj)
+        try:
+            hash(entries)  # fast path for hashable entries
+        except TypeError:
+            entries = tuple(content_key(o) for o in obj)
+        return obj.__class__, entries
+    if isinstance(obj, Mapping):
+        return obj.__class__, frozenset((content_key(k), content_key(v)) for k, v in iteritems(obj))
+    if isinstance(obj, (set, frozenset)):
+        return obj.__class__, frozenset(content_key(o) for o in obj)
+    hash(obj)  # raises TypeError if not hashable
+    return obj
+
+
+def _content_key_args(args, kwargs):
+    return content_key(args), content_key(kwargs) if kwargs else None
+
+
+class Cached(object):
+    """ memoizing fmap with LRU and optional time-to-live eviction, e.g.
+    >>> f_cached = lift(f, Cached(maxsize=100, ttl=60))
+    >>> f_cached_sum = lift(f, Cached(), summap)  # caches single entries
+
+    Unhashable args like ndarrays, lists or dicts are hashed by content (see ``content_key``), args which cannot be
+    keyed at all bypass the cache. Hit and miss counts are available as ``hits`` and ``misses``. The cache is
+    thread-safe, however concurrent calls with the same uncached args may compute f more than once.
+    CAUTION: cached outputs are returned as is, hence must not be mutated.
+    """
+    def __init__(self, maxsize=128, ttl=None, key=_content_key_args):
+        """
+        Parameters
+        ----------
+        maxsize : int
+            maximal number of cached outputs (per Cached instance), the least recently used are evicted first.
+            None for unbounded
+        ttl : float
+            seconds after which cached outputs expire, None for never
+        key : function
+            mapping (args, kwargs) to a hashable key, defaults to content hashing
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key
+        self.outputs = OrderedDict()  # (f, key) --> (expiry time, output), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, f, *args, **kwargs):
+        try:
+            key = (f, self.key(args, kwargs))
+            hash(key)
+        except TypeError:  # cannot be keyed, hence cannot be cached
+            return f(*args, **kwargs)
+        with self._lock:
+            try:
+                expiry, output = self.outputs.pop(key)
+            except KeyError:
+                pass
+            else:
+                if expiry is None or default_timer() < expiry:
+                    self.outputs[key] = expiry, output  # reinsert as most recently used
+                    self.hits += 1
+                    return output
+            self.misses += 1
+        output = f(*args, **kwargs)  # without lock, as f may take long
+        with self._lock:
+            self.outputs[key] = (None if self.ttl is None else default_timer() + self.ttl), output
+            while self.maxsize is not None and len(self.outputs) > self.maxsize:
+                self.outputs.popitem(last=False)
+        return output
+
+    def clear(self):
+        with self._lock:
+            self.outputs.clear()
+            self.hits = self.misses = 0
+
+cached = Cached
+
+
+# errors of pickling unsupported objects (python 3 raises AttributeError e.g. for local functions)
+_UNPICKLABLE = (cPickle.PicklingError, TypeError, AttributeError)
+
+
+def _global_names(code):
+    """ names which code (including nested functions) may look up as globals """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _update_digest(digest, obj, seen):
+    if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        digest.update(("ndarray %s %r " % (obj.dtype.str, obj.shape)).encode("utf-8"))
+        digest.update(np.ascontiguousarray(obj))
+    elif isinstance(obj, (list, tuple)):
+        digest.update(("%s %i " % (obj.__class__.__name__, len(obj))).encode("utf-8"))
+        for o in obj:
+            _update_digest(digest, o, seen)
+    elif isinstance(obj, (Mapping, set, frozenset)):  # order independent
+        items = iteritems(obj) if isinstance(obj, Mapping) else ((o,) for o in obj)
+        digest.update(("%s %i " % (obj.__class__.__name__, len(obj))).encode("utf-8"))
+        for d in sorted(_content_digest(item, seen) for item in items):
+            digest.update(d.encode("ascii"))
+    elif isinstance(obj, FunctionType):  # by code and state, as functions are pickled by reference only
+        digest.update(("function %s.%s " % (obj.__module__, obj.__name__)).encode("utf-8"))
+        if id(obj) in seen:  # recursive functions
+            return
+        seen.add(id(obj))
+        _update_digest(digest, obj.__code__, seen)
+        _update_digest(digest, (obj.__defaults__, getattr(obj, '__kwdefaults__', None)), seen)
+        try:
+            closure = [cell.cell_contents for cell in obj.__closure__ or ()]
+        except ValueError:  # empty cell, i.e. state which cannot be digested
+            raise TypeError("cannot digest closure of %r" % obj)
+        _update_digest(digest, closure, seen)
+        referenced = sorted(_global_names(obj.__code__) & set(obj.__globals__))
+        _update_digest(digest, {name: obj.__globals__[name] for name in referenced}, seen)
+    elif isinstance(obj, ModuleType):
+        digest.update(("module %s " % obj.__name__).encode("utf-8"))
+    elif isinstance(obj, CodeType):  # names matter too, e.g. ``x.sum()`` and ``x.mean()`` share their bytecode
+        digest.update(("code %i %i %i " % (obj.co_argcount, getattr(obj, 'co_kwonlyargcount', 0), obj.co_flags)
+                       ).encode("utf-8"))
+        digest.update(obj.co_code)
+        _update_digest(digest, (obj.co_names, obj.co_varnames, obj.co_freevars), seen)
+        _update_digest(digest, obj.co_consts, seen)
+    elif isinstance(obj, MethodType):
+        _update_digest(digest, (obj.__func__, obj.__self__), seen)
+    elif isinstance(obj, partial):
+        _update_digest(digest, (obj.func, obj.args, obj.keywords or {}), seen)
+    else:
+        digest.update(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+
+
+def _content_digest(obj, seen):
+    digest = hashlib.sha1()
+    _update_digest(digest, obj, seen)
+    return digest.hexdigest()
+
+
+def content_digest(obj):
+    """ sha1 hexdigest of obj's content, which unlike ``hash`` or ``content_key`` is stable across processes
+
+    Python functions are identified by module, name and code, together with their defaults, closure contents and the
+    globals they refer to (modules by name). Other objects are identified by their pickle, ndarrays by dtype, shape and
+    data.
+
+    Raises
+    ------
+    pickle errors or TypeError if obj (or some part of it, e.g. a referenced global) cannot be digested
+    """
+    return _content_digest(obj, set())
+
+
+class DiskCache(object):
+    """ persistent memoizing fmap, storing outputs in a local directory keyed by the content of function and args
+
+    ndarrays are stored as ``.npy`` files (and loaded memory-mapped by default), everything else as pickle. Works
+    across processes and restarts, e.g.
+    >>> f_estimate = lift(f, Average(1000), DiskCache("~/.cache/myproject"))  # caches the whole average
+    >>> @as_wrapper(DiskCache())
+    ... def expensive(x): ...
+
+    The least recently used files are deleted as soon as the directory exceeds ``max_bytes``. Calls which cannot be
+    digested (see ``content_digest``) or outputs which cannot be pickled bypass the cache.
+    """
+    def __init__(self, directory=os.path.join("~", ".cache", "schlichtanders"), max_bytes=2**30, mmap_mode='r'):
+        """
+        Parameters
+        ----------
+        directory : str
+            cache directory, created if not existent. Do not share it with other files, as they may be evicted.
+        max_bytes : int
+            size cap of the cache directory, None for unbounded
+        mmap_mode : str
+            passed to ``numpy.load`` for ``.npy`` files, None to load them fully into memory. With the default 'r'
+            returned arrays are read-only ``numpy.memmap``s, also on the first (missing) call, so copy them before
+            writing into them.
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _load(self, path):
+        if path.endswith(".npy"):
+            return np.load(path, mmap_mode=self.mmap_mode)
+        with open(path, "rb") as f:
+            return cPickle.load(f)
+
+    def _store(self, digest, output):
+        is_array = isinstance(output, np.ndarray) and not output.dtype.hasobject
+        path = os.path.join(self.directory, digest + (".npy" if is_array else ".pkl"))
+        tmp_path = "%s.%i.%i.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_path, "wb") as f:
+                if is_array:
+                    np.save(f, output)
+                else:
+                    cPickle.dump(output, f, cPickle.HIGHEST_PROTOCOL)
+        except _UNPICKLABLE:  # cannot be stored, simply do not cache
+            os.remove(tmp_path)
+            return None
+        try:
+            os.rename(tmp_path, path)  # atomic, i.e. other processes see either nothing or the complete file
+        except OSError:  # e.g. on Windows, if another process has just stored the same digest, keep that
+            os.remove(tmp_path)
+        self.evict()
+        return path
+
+    def __call__(self, f, *args, **kwargs):
+        try:
+            digest = content_digest((f, args, kwargs))
+        except _UNPICKLABLE:  # cannot be keyed, hence cannot be cached
+            return f(*args, **kwargs)
+        for path in (os.path.join(self.directory, digest + ext) for ext in (".npy", ".pkl")):
+            try:
+                output = self._load(path)
+                os.utime(path, None)  # mark as recently used
+            except (IOError, OSError):  # not cached (or just evicted by another process)
+                continue
+            self.hits += 1
+            return output
+        self.misses += 1
+        output = f(*args, **kwargs)
+        path = self._store(digest, output)
+        if path is not None and path.endswith(".npy") and self.mmap_mode is not None:
+            try:  # the same kind of (e.g. read-only memory-mapped) array as on later hits
+                return self._load(path)
+            except (IOError, OSError):  # evicted already
+                pass
+        return output
+
+    def _files(self):
+        """ [(modification time, size, path)] of all cached files """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith((".npy", ".pkl")):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # evicted concurrently
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """ deletes the least recently used files until the directory is at most ``max_bytes`` large """
+        if self.max_bytes is None:
+            return
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self._files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.hits = self.misses = 0
+
 """
 function composition
 --------------------
@@ -425,6 +1576,120 @@ def identity(x):
     return x
 
 
+class StageCache(object):
+    """ LRU memoization of a single function's outputs, used by ``compose(..., cache=n)`` """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.outputs = OrderedDict()  # (args, kwargs) --> output, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, f, args, kwargs):
+        try:
+            key = content_key((args, kwargs))  # also ndarrays, which are typical intermediate outputs
+        except TypeError:  # args which cannot be keyed, cannot be cached
+            return f(*args, **kwargs)
+        try:
+            output = self.outputs.pop(key)
+            self.hits += 1
+        except KeyError:
+            output = f(*args, **kwargs)
+            self.misses += 1
+            if len(self.outputs) >= self.maxsize:
+                self.outputs.popitem(last=False)
+        self.outputs[key] = output  # (re)insert as most recently used
+        return output
+
+    def clear(self):
+        self.outputs.clear()
+        self.hits = self.misses = 0
+
+
+class StageProfile(object):
+    """ call statistics of each function of a composition, used by ``compose(..., profile=True)``
+
+    Per function, the number of calls, cumulative and maximal wall time (in seconds) and the last and maximal output
+    size are recorded. Sizes are ``nbytes`` for arrays, else the shallow ``sys.getsizeof``.
+    Besides, the first ``max_events`` calls are recorded as events for ``chrome_trace``.
+    """
+
+    def __init__(self, funcs, max_events=100000):
+        self.names = [getattr(f, '__name__', f.__class__.__name__) for f in funcs]
+        self.max_events = max_events
+        self.clear()
+
+    def clear(self):
+        n = len(self.names)
+        self.counts = [0] * n
+        self.total_times = [0.0] * n
+        self.max_times = [0.0] * n
+        self.output_sizes = [None] * n
+        self.max_output_sizes = [None] * n
+        self.events = []  # (index, start, duration)
+        self.start = default_timer()
+
+    def record(self, i, start, duration, output):
+        self.counts[i] += 1
+        self.total_times[i] += duration
+        self.max_times[i] = max(self.max_times[i], duration)
+        size = getattr(output, 'nbytes', None)
+        if size is None:
+            size = sys.getsizeof(output)
+        self.output_sizes[i] = size
+        if self.max_output_sizes[i] is None or size > self.max_output_sizes[i]:
+            self.max_output_sizes[i] = size
+        if len(self.events) < self.max_events:
+            self.events.append((i, start, duration))
+
+    def as_dict(self):
+        """ statistics by function name (prefixed with the function's position in call order) """
+        return OrderedDict(
+            ("%i %s" % (i, name), dict(
+                count=self.counts[i],
+                total_time=self.total_times[i],
+                max_time=self.max_times[i],
+                mean_time=self.total_times[i] / self.counts[i] if self.counts[i] else None,
+                output_size=self.output_sizes[i],
+                max_output_size=self.max_output_sizes[i],
+            ))
+            for i, name in enumerate(self.names)
+        )
+
+    def table(self):
+        """ statistics as printable table, one row per function in call order """
+        rows = ["%3s %-30s %8s %12s %12s %12s" % ("#", "function", "count", "total [s]", "max [s]", "max size")]
+        for i, name in enumerate(self.names):
+            rows.append("%3i %-30s %8i %12.6f %12.6f %12s" % (
+                i, name[:30], self.counts[i], self.total_times[i], self.max_times[i], self.max_output_sizes[i]))
+        return "\n".join(rows)
+
+    def __str__(self):
+        return self.table()
+
+    def chrome_trace(self, filename=None):
+        """ recorded events in Chrome's trace event format (open with chrome://tracing)
+
+        Parameters
+        ----------
+        filename : str
+            if given, the trace is written to this file
+
+        Returns
+        -------
+        trace as json string
+        """
+        trace = json.dumps({"traceEvents": [
+            dict(name=self.names[i], cat="compose", ph="X", pid=os.getpid(), tid=0,
+                 ts=(start - self.start) * 1e6, dur=duration * 1e6)
+            for i, start, duration in self.events
+        ]})
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(trace)
+        return trace
+
+
 def compose(*funcs, **kwargs):
     """ Higher level function to compose several functions
 
@@ -445,6 +1710,15 @@ def compose(*funcs, **kwargs):
 
     expand_tuple : bool (default True)
         If True expand a return value of type tuple, so that next function is called like ``f(*tuple)``
+    cache : int (default 0)
+        If positive, the output of each function is memoized on its args and the kwargs it actually gets, keeping the
+        ``cache`` most recently used outputs per function. Rerunning with only a late-stage kwarg changed then only
+        recomputes the later functions. Args are keyed by content (see ``content_key``), also ndarrays and lists,
+        calls with args which cannot be keyed at all are not cached.
+        The caches are available as ``composed.caches`` (in call order).
+    profile : bool (default False)
+        If True, call counts, wall times and output sizes of each function are recorded in a ``StageProfile``,
+        available as ``composed.profile``. If False, there is no overhead at all.
 
     Returns
     -------
@@ -452,21 +1726,61 @@ def compose(*funcs, **kwargs):
     """
     firstlatest = kwargs.get("firstlatest", True)  #: python 2.7 workaround for keywords after *args
     expand_tuple = kwargs.get("expand_tuple", True)  #: python 2.7 workaround for keywords after *args
+    cache = kwargs.get("cache", 0)  #: python 2.7 workaround for keywords after *args
+    profile = kwargs.get("profile", False)  #: python 2.7 workaround for keywords after *args
     funcs = funcs[::-1] if firstlatest else funcs
     funcs = [f for f in funcs if f != identity]
     if not funcs:
         funcs = [identity]
 
-    def composed(*args, **kwargs):  # TODO build a useful function documentation like usual for function wrappers
-        def call(args, f):
-            """ call which also passes kwargs arguments """
-            if expand_tuple and isinstance(args, tuple):  # i.e. expand *args
-                return use_as_needed(f, kwargs, args=args)
+    # the kwargs routing of each function is looked up only once, on the first call, and reused afterwards
+    # (lazily, so that composing does not yet need inspectable functions)
+    routes = []
+    caches = [StageCache(cache) for _ in funcs] if cache > 0 else None
+    profile = StageProfile(funcs) if profile else None
+
+    def routed(*args, **kwargs):
+        if not routes:
+            routes[:] = [(f, kwargs_plan(f)) for f in funcs]  # single assignment, hence thread-safe
+        for i, (f, plan) in enumerate(routes):
+            if profile is not None:
+                start = default_timer()
+            if not (expand_tuple and isinstance(args, tuple)):  # i.e. only tuples are expanded as *args
+                args = (args,)
+            # same as use_as_needed(f, kwargs, args=args), only with precomputed plan
+            if plan is None:
+                f_kwargs = kwargs
+            elif kwargs:
+                f_kwargs = {k: kwargs[k] for k in plan[len(args):] if k in kwargs}
             else:
-                return use_as_needed(f, kwargs, args=[args])
-        return reduce(call, funcs, args)
-
-    return composed
+                f_kwargs = {}
+            if caches is None:
+                args = f(*args, **f_kwargs)
+            else:
+                args = caches[i](f, args, f_kwargs)
+            if profile is not None:
+                profile.record(i, start, default_timer() - start, args)
+        return args
+
+    if caches is not None or profile is not None:
+        routed.caches = caches
+        routed.profile = profile
+        return routed
+
+    # calls without kwargs need no routing at all. For them the nested calls are generated as source code
+    # (like namedtuple does), which is about as fast as hand-written nested calls
+    source = ["def composed(*args, **kwargs):",
+              "    if kwargs:",
+              "        return routed(*args, **kwargs)",
+              "    r = f0(*args)" if expand_tuple else "    r = f0(args)"]
+    for i in xrange(1, len(funcs)):
+        source.append("    r = f%i(*r) if isinstance(r, tuple) else f%i(r)" % (i, i) if expand_tuple else
+                      "    r = f%i(r)" % i)
+    source.append("    return r")
+    namespace = {"f%i" % i: f for i, f in enumerate(funcs)}
+    namespace['routed'] = routed
+    exec("\n".join(source), namespace)
+    return namespace['composed']
 
 
 class Compose(object):
@@ -486,6 +1800,7 @@ class Compose(object):
     The . syntax might not be recommandable as this might confuse others. It is not meant as an operator (the operator
     functionality uses python's frame hack). At least use it with spaces inbetween, so that it looks more like an operator.
     """
+    _compiled = None  # see compile
 
     def __init__(self, *funcs, **kwargs):
         """ Generic Compose class for functions. Use it as if this would be a higher level function.
@@ -496,12 +1811,18 @@ class Compose(object):
             functions to be concatinated. (func1, func2, func3) -> func1(func2(func3(...))).
         expand_tuple : bool (default True)
             If True expand a return value of type tuple, so that next function is called like ``f(*tuple)``
+        cache : int (default 0)
+            If positive, the outputs of each function are memoized, see ``compose``
+        profile : bool (default False)
+            If True, each function's calls are recorded, see ``compose`` and ``stage_profile``
 
         Returns
         -------
         concatinated functions
         """
         self.expand_tuple = kwargs.get("expand_tuple", True)  #: python 2.7 workaround for keywords after *args
+        self.cache = kwargs.get("cache", 0)  #: python 2.7 workaround for keywords after *args
+        self.profile = kwargs.get("profile", False)  #: python 2.7 workaround for keywords after *args
         if len(funcs) == 1 and isinstance(funcs[0], list):  # regarded single list of funcs as funcs itself
             self.funcs = funcs[0]
         else:
@@ -522,26 +1843,69 @@ class Compose(object):
         -------
         output of very last function
         """
-        return compose(*self.funcs, expand_tuple=self.expand_tuple)(*args, **kwargs)
+        return self.compile()(*args, **kwargs)
+
+    def compile(self):
+        """ builds the composed function once, including the kwargs routing for each function
+
+        The compiled function is kept and reused by ``__call__``, so that calling costs about the same as
+        hand-written nested calls. ``+=`` invalidates it, after changing ``funcs``, ``expand_tuple``, ``cache`` or
+        ``profile`` by hand call ``recompile`` instead.
+
+        Returns
+        -------
+        compiled composed function
+        """
+        if self._compiled is None:
+            self._compiled = compose(*self.funcs, expand_tuple=self.expand_tuple, cache=self.cache,
+                                     profile=self.profile)
+        return self._compiled
+
+    @property
+    def caches(self):
+        """ the ``StageCache`` of each function (in call order), empty if caching is not enabled """
+        return getattr(self.compile(), 'caches', None) or []
+
+    @property
+    def stage_profile(self):
+        """ the ``StageProfile`` of the compiled functions, None if profiling is not enabled """
+        return getattr(self.compile(), 'profile', None)
+
+    def recompile(self):
+        self._compiled = None
+        return self.compile()
+
+    def __getstate__(self):  # the compiled function is a closure, which cannot be pickled, hence compile again
+        state = self.__dict__.copy()
+        state.pop('_compiled', None)
+        return state
+
+    def __setstate__(self, state):  # explicitly, as __getattr__ would be asked for it otherwise
+        self.__dict__.update(state)
 
     def __iadd__(self, other):
         if isinstance(other, Compose):
             self.funcs += other.funcs
         else:  # check function instance?
             self.funcs.append(other)
+        self._compiled = None
         return self
 
+    def _options(self):
+        """ kwargs to construct a Compose with the same options, used when concatenating """
+        return dict(expand_tuple=self.expand_tuple, cache=self.cache, profile=self.profile)
+
     def __add__(self, other):
         if isinstance(other, Compose):
-            return Compose(self.funcs + other.funcs)
+            return self.__class__(self.funcs + other.funcs, **self._options())
         else: #check function instance?
-            return Compose(self.funcs + [other])
+            return self.__class__(self.funcs + [other], **self._options())
 
     def __radd__(self, lother):
         if isinstance(lother, Compose):
-            return Compose(lother.funcs + self.funcs)
+            return self.__class__(lother.funcs + self.funcs, **self._options())
         else:  # check function instance?
-            return Compose([lother] + self.funcs)
+            return self.__class__([lother] + self.funcs, **self._options())
 
     def __getattr__(self, name):
         """ overwriting . to work as +
@@ -558,3 +1922,146 @@ class Compose(object):
         return self + func
 
 I = Compose()
+
+
+def _use_as_needed_packed(packed):
+    """ ``use_as_needed`` with all arguments packed into one tuple, as executors map over single arguments """
+    func, kwargs, args = packed
+    return use_as_needed(func, kwargs, args=args)
+
+
+class Parallel(object):
+    """ fan-out combinator for compose/Compose: calls all functions on the same args and returns their outputs as tuple
+
+    Within a Compose chain, the next function hence gets the outputs as *args (see ``expand_tuple``).
+    Like within compose, each function only gets the kwargs it supports.
+    """
+
+    def __init__(self, *funcs, **kwargs):
+        """
+        Parameters
+        ----------
+        funcs : functions
+            branches, all called with the same args
+        executor : executor or pool (default None)
+            anything with ``map(func, iterable)``, e.g. ``multiprocessing.pool.ThreadPool``, ``multiprocessing.Pool``
+            or ``concurrent.futures`` executors. Branches run concurrently on it, by default serially.
+            For process pools the functions have to be picklable.
+        """
+        self.funcs = funcs
+        self.executor = kwargs.get("executor", None)  #: python 2.7 workaround for keywords after *args
+
+    def __call__(self, *args, **kwargs):
+        _map = map if self.executor is None else self.executor.map
+        return tuple(_map(_use_as_needed_packed, [(f, kwargs, args) for f in self.funcs]))
+
+
+class Map(object):
+    """ fan-out combinator for compose/Compose: calls the function on each of its args separately, returning a tuple
+
+    I.e. ``Map(f)(a, b, c) == (f(a), f(b), f(c))``, which fits previous functions returning tuples (see ``expand_tuple``).
+    Like within compose, the function only gets the kwargs it supports.
+    """
+
+    def __init__(self, func, executor=None):
+        """
+        Parameters
+        ----------
+        func : function
+            to be called on each arg
+        executor : executor or pool
+            like for ``Parallel``
+        """
+        self.func = func
+        self.executor = executor
+
+    def __call__(self, *args, **kwargs):
+        _map = map if self.executor is None else self.executor.map
+        return tuple(_map(_use_as_needed_packed, [(self.func, kwargs, (a,)) for a in args]))
+
+
+"""
+batching
+--------
+"""
+
+
+class _PendingCall(object):
+    __slots__ = ('item', 'result', 'exception', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+
+class Batched(object):
+    """ scalar function ``f(item)`` which coalesces concurrent calls (e.g. from several threads) into batched calls
+
+    A background thread collects the pending items into a list, up to ``max_batch`` items or as many as arrive within
+    ``max_wait_ms`` after the first one, calls ``f_batch(items)`` once and scatters the results back to the callers.
+    Hence expensive vectorized implementations are used efficiently without restructuring the calling code, e.g.
+    >>> predict = Batched(lambda xs: model.predict(np.array(xs)), max_batch=256, max_wait_ms=2)
+    >>> pool.map(predict, requests)  # each predict call blocks until its batch is done
+
+    If ``f_batch`` raises, the exception is raised in each caller of the batch.
+    """
+    def __init__(self, f_batch, max_batch=64, max_wait_ms=5):
+        """
+        Parameters
+        ----------
+        f_batch : function
+            mapping a list of items to a sequence of results of the same length and order
+        max_batch : int
+            maximal number of items per batch
+        max_wait_ms : float
+            maximal time in milliseconds to wait for further items after the first one of a batch
+        """
+        self.f_batch = f_batch
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def __call__(self, item):
+        pending = _PendingCall(item)
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._work, name="Batched worker")
+                    self._worker.daemon = True
+                    self._worker.start()
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.exception is not None:
+            raise pending.exception
+        return pending.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = default_timer() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch:
+            timeout = deadline - default_timer()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._collect()
+            try:
+                results = list(self.f_batch([p.item for p in batch]))
+                if len(results) != len(batch):
+                    raise ValueError("f_batch returned %i results for %i items" % (len(results), len(batch)))
+            except Exception as e:
+                for p in batch:
+                    p.exception = e
+            else:
+                for p, result in izip(batch, results):
+                    p.result = result
+            for p in batch:
+                p.done.set()
@@ -10,6 +10,7 @@ from timeit import default_timer
 import numpy as np
 import random
 
+from collections import Sequence
 from schlichtanders.myfunctools import convert
 
 inf = float("inf")
@@ -36,7 +37,7 @@ def run(gen):
 
 
 def cycle_permute(listlike):
-    listlike = convert(listlike, list)
+    listlike = convert(listlike, Sequence)  # only indexing is needed, so arrays need not be copied
     while True:
         for i in np.random.permutation(len(listlike)):
             yield listlike[i]
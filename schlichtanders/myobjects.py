@@ -4,12 +4,15 @@ python-like complex access to datastructures. E.g. pyparsing uses a similar inte
 from __future__ import print_function, division
 
 from mygenerators import deleteallbutone
-from itertools import islice
+from itertools import islice, izip
 import cPickle
+import re
 import sys
+from array import array
+from keyword import iskeyword
 from copy import deepcopy
 from itertools import count
-from collections import Mapping, Sequence, MutableSet
+from collections import Mapping, Sequence, MutableSet, Set, Sized
 import types
 import weakref
 from six import string_types
@@ -66,18 +69,245 @@ class Namespace(object):
 Empty = Struct = Namespace
 
 
+_identifier = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+
+def _split_fields(fields):
+    if isinstance(fields, string_types):
+        fields = fields.replace(',', ' ').split()
+    fields = tuple(fields)
+    for field in fields:
+        if not _identifier.match(field) or iskeyword(field) or field.startswith('__'):
+            raise ValueError("invalid field name %r" % field)
+    return fields
+
+
+def create_record(classname, fields):
+    """ this factory method creates a Namespace-like record class with ``__slots__`` for the given fields
+
+    Records have no ``__dict__``, which makes them several times smaller than ``Namespace`` instances, suitable
+    for millions of lightweight rows. Like for namedtuple, ``fields`` may also be a single string of field names.
+    Missing fields default to None.
+    CAUTION: for pickle to work, the classname must be the same name as the variable this factory-call is set to """
+    fields = _split_fields(fields)
+
+    # __init__ is generated like in namedtuple, as setattr in a loop would be several times slower
+    init_source = "def __init__(self, %s):\n%s" % (
+        ", ".join("%s=None" % f for f in fields),
+        "".join("    self.%s = %s\n" % (f, f) for f in fields) or "    pass\n")
+    init_namespace = {}
+    exec(init_source, init_namespace)
+
+    class Record(object):
+        __slots__ = fields
+        _fields = fields
+        __init__ = init_namespace['__init__']
+
+        def _asdict(self):
+            return {f: getattr(self, f) for f in self._fields}
+
+        def __getstate__(self):
+            return tuple(getattr(self, f) for f in self._fields)
+
+        def __setstate__(self, state):
+            for f, value in izip(self._fields, state):
+                setattr(self, f, value)
+
+        def __repr__(self):
+            return "%s(%s)" % (self.__class__.__name__,
+                               ", ".join("%s=%r" % (f, getattr(self, f)) for f in self._fields))
+
+    # like in create_counter, for pickling to work the __module__ needs to be the module of the caller
+    try:
+        Record.__module__ = sys._getframe(1).f_globals.get('__name__', '__main__')
+    except (AttributeError, ValueError):
+        pass
+    Record.__name__ = classname
+    return Record
+
+
+class StructOfArrays(Sequence):
+    """ stores records column-wise, i.e. one array per field instead of one object per record
+
+    Columns can be anything indexable of equal length, by default they are ``array.array`` of the given
+    ``typecodes`` (a single typecode for all, or a dict field -> typecode). Numpy arrays work as well.
+    Single records are accessible as Namespace-like ``RecordView``, whole columns as attributes, e.g. ``soa.x``,
+    which allows vectorized computations on numpy columns (see ``to_numpy``).
+    Appending needs columns which support ``append``/``extend``, like ``array.array`` or lists.
+    """
+
+    def __init__(self, fields, columns=None, typecodes='d'):
+        self.fields = _split_fields(fields)
+        columns = {} if columns is None else dict(columns)
+        if isinstance(typecodes, string_types):
+            typecodes = dict.fromkeys(self.fields, typecodes)
+        for f in self.fields:
+            if f not in columns:
+                columns[f] = array(typecodes[f])
+        if len(set(len(columns[f]) for f in self.fields)) > 1:
+            raise ValueError("all columns must have the same length")
+        self.columns = columns
+
+    @classmethod
+    def from_records(cls, records, fields, typecodes='d'):
+        """ builds columns from records with attributes for all fields, like Namespaces or ``create_record`` rows """
+        soa = cls(fields, typecodes=typecodes)
+        soa.extend(records)
+        return soa
+
+    def append(self, *args, **kwargs):
+        """ appends a single record, given by field values like for ``create_record`` classes """
+        values = dict(izip(self.fields, args), **kwargs)
+        for f in self.fields:
+            self.columns[f].append(values[f])
+
+    def extend(self, records):
+        if not isinstance(records, Sequence):
+            records = list(records)
+        for f in self.fields:
+            self.columns[f].extend([getattr(r, f) for r in records])
+
+    def to_numpy(self):
+        """ new StructOfArrays with numpy columns (``array.array`` columns are copied at memcpy speed) """
+        import numpy as np
+        return StructOfArrays(self.fields, {
+            f: np.frombuffer(c, dtype=c.typecode).copy() if isinstance(c, array) else np.asarray(c)
+            for f, c in self.columns.iteritems()
+        })
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]]) if self.fields else 0
+
+    def __getitem__(self, index):
+        """ integers give a RecordView, slices a new StructOfArrays of the sliced columns """
+        if isinstance(index, slice):
+            return StructOfArrays(self.fields, {f: c[index] for f, c in self.columns.iteritems()})
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("record index out of range")
+        return RecordView(self, index)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('columns', 'fields'):  # not yet initialized
+            raise AttributeError(name)
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return "%s(%r, %d records)" % (self.__class__.__name__, self.fields, len(self))
+
+
+class RecordView(object):
+    """ Namespace-like view on a single record of a ``StructOfArrays``, reading and writing through to its columns """
+    __slots__ = '_soa', '_index'
+
+    def __init__(self, soa, index):
+        object.__setattr__(self, '_soa', soa)
+        object.__setattr__(self, '_index', index)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):  # not yet initialized
+            raise AttributeError(name)
+        try:
+            return self._soa.columns[name][self._index]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        try:
+            column = self._soa.columns[name]
+        except KeyError:
+            raise AttributeError(name)
+        column[self._index] = value
+
+    def _asdict(self):
+        return {f: getattr(self, f) for f in self._soa.fields}
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+                           ", ".join("%s=%r" % (f, getattr(self, f)) for f in self._soa.fields))
+
+
 from mycontextmanagers import until_stopped, ignored
 
 
+_missing = object()  # marks a failed lookup, as None is a valid attribute value
+
+
 class NestedNamespace(object):
+    """ looks up attributes in the given instances in turn, the first instance having the attribute wins
+
+    Which instance owns which name is cached. Attribute values are still read from the owner, hence only if an
+    instance gains or loses attributes, ``invalidate`` needs to be called. Setting ``instances`` invalidates
+    automatically. With ``freeze`` all attributes are flattened into a single dict instead.
+    """
+    _instances = ()
+    _owners = None  # name --> owning instance (None if no instance has the name)
+    _frozen = None  # name --> value, if frozen
 
     def __init__(self, *instances):
         self.instances = instances
 
+    @property
+    def instances(self):
+        return self._instances
+
+    @instances.setter
+    def instances(self, instances):
+        self._instances = instances
+        self.invalidate()
+
+    def invalidate(self, name=None):
+        """ forgets the cached owner of ``name`` (or all cached owners if None) """
+        if name is None or self._owners is None:
+            self._owners = {}
+        else:
+            self._owners.pop(name, None)
+
+    def freeze(self):
+        """ flattens all attributes of all instances into one dict, making lookups O(1)
+
+        Later changes to the instances are not seen until ``unfreeze`` (or another ``freeze``). Nested
+        NestedNamespaces are flattened as well, but are not frozen themselves. """
+        self._frozen = None
+        self._frozen = self._attributes()
+        return self
+
+    def _attributes(self):
+        """ dict of all attributes as currently seen by lookups, without changing anything """
+        if self._frozen is not None:
+            return self._frozen
+        attributes = {}
+        for ins in reversed(self.instances):  # first instances overwrite later ones
+            if isinstance(ins, NestedNamespace):
+                attributes.update(ins._attributes())
+            else:
+                attributes.update((name, getattr(ins, name)) for name in dir(ins) if not name.startswith('__'))
+        return attributes
+
+    def unfreeze(self):
+        self._frozen = None
+        return self
+
     def __getattr__(self, name):
-        for ins in self.instances:
-            with ignored(AttributeError):
-                return getattr(ins, name)
+        if name.startswith('__'):  # do not resolve special lookups like __getstate__ (nor before __init__)
+            raise AttributeError(name)
+        if self._frozen is not None:
+            return self._frozen.get(name)
+        try:
+            owner = self._owners[name]
+        except KeyError:
+            for owner in self.instances:
+                if getattr(owner, name, _missing) is not _missing:
+                    break
+            else:
+                owner = None
+            self._owners[name] = owner
+        return None if owner is None else getattr(owner, name)
 
 
 
@@ -536,6 +766,7 @@ def check_deterministic(iterable):
 
 
 class Link(object):
+    # Not used by OrderedSet anymore, but kept for unpickling OrderedSets pickled with the former linked-list version.
     # This make that we need to use a different pickle protocol
     # then the default.  Othewise, there is pickling errors
     __slots__ = 'prev', 'next', 'key', '__weakref__'
@@ -558,15 +789,77 @@ class Link(object):
             self.key = state[2]
 
 
+_deleted = object()  # tombstone marking the slot of a discarded key in ``OrderedSet``
+
+
+class _LiveSlots(object):
+    """ Fenwick tree counting the live (not discarded) slots of ``OrderedSet``'s key list
+
+    Translates between positions among the live keys and slots of the list in O(log n), so that positional access
+    needs no compaction.
+    """
+    __slots__ = ('tree',)
+
+    def __init__(self, alive):
+        self.tree = tree = [0] + [int(a) for a in alive]  # 1-based
+        n = len(alive)
+        for i in xrange(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+
+    def _update(self, i, delta):
+        tree = self.tree
+        i += 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def count_before(self, slot):
+        """ number of live slots before ``slot`` """
+        tree = self.tree
+        total = 0
+        while slot > 0:
+            total += tree[slot]
+            slot -= slot & -slot
+        return total
+
+    def remove(self, slot):
+        self._update(slot, -1)
+
+    def add(self, slot):
+        """ marks ``slot`` as alive, extending the tree if ``slot`` is just behind its end """
+        tree = self.tree
+        if slot < len(tree) - 1:  # slot was trimmed from the key list before
+            self._update(slot, 1)
+        else:  # new node i covers the slots (i - lowbit(i), i], of which only the new one is alive
+            i = len(tree)
+            tree.append(1 + self.count_before(i - 1) - self.count_before(i - (i & -i)))
+
+    def find(self, index):
+        """ slot of the live key at position ``index`` """
+        tree = self.tree
+        slot = 0
+        step = 1
+        while step * 2 < len(tree):
+            step *= 2
+        while step:
+            if slot + step < len(tree) and tree[slot + step] <= index:
+                slot += step
+                index -= tree[slot]
+            step //= 2
+        return slot
+
+
 class OrderedSet(MutableSet):
     'Set the remembers the order elements were added'
     # Big-O running times for all methods are the same as for regular sets.
-    # The internal self.__map dictionary maps keys to links in a doubly linked list.
-    # The circular doubly linked list starts and ends with a sentinel element.
-    # The sentinel element never gets deleted (this simplifies the algorithm).
-    # The prev/next links are weakref proxies (to prevent circular references).
-    # Individual links are kept alive by the hard reference in self.__map.
-    # Those hard references disappear when a key is deleted from an OrderedSet.
+    # The keys are stored in insertion order in the list self.__keys, the dictionary self.__map maps keys to their
+    # position within this list. Discarded keys leave a tombstone ``_deleted`` behind, so that no other position
+    # has to be updated. As soon as there are more tombstones than keys, the list gets compacted (amortized O(1)).
+    # self.__head points to the first slot which may still be alive, so that ``pop(last=False)`` need not rescan
+    # leading tombstones again and again.
+    # (Former versions used a doubly linked list of weakrefs, see ``Link``, which is only kept for unpickling)
 
     # Added by IG-- pre-existing theano code expected sets
     #   to have this method
@@ -577,9 +870,10 @@ class OrderedSet(MutableSet):
     def __init__(self, iterable=None):
         # Checks added by IG
         check_deterministic(iterable)
-        self.__root = root = Link()         # sentinel node for doubly linked list
-        root.prev = root.next = weakref.ref(root)
-        self.__map = {}                     # key --> link
+        self.__keys = []                    # keys in order, with tombstones
+        self.__map = {}                     # key --> position in self.__keys
+        self.__head = 0                     # all positions before are tombstones
+        self.__live = None                  # _LiveSlots for positional access, only if needed
         if iterable is not None:
             self |= iterable
 
@@ -590,77 +884,166 @@ class OrderedSet(MutableSet):
         return key in self.__map
 
     def add(self, key):
-        # Store new key in a new link at the end of the linked list
+        # Store new key at the end of the list
         if key not in self.__map:
-            self.__map[key] = link = Link()
-            root = self.__root
-            last = root.prev
-            link.prev, link.next, link.key = last, weakref.ref(root), key
-            last().next = root.prev = weakref.ref(link)
+            if self.__live is not None:
+                self.__live.add(len(self.__keys))
+            self.__map[key] = len(self.__keys)
+            self.__keys.append(key)
+
+    def __extend(self, iterable):
+        keys, _map = self.__keys, self.__map
+        new = list(iterable)
+        # key --> position of its first occurrence within new (hence built in reverse)
+        first = dict(izip(reversed(new), xrange(len(new) - 1, -1, -1)))
+        if len(first) < len(new) or _map.viewkeys() & first.viewkeys():
+            new = [key for i, key in enumerate(new) if first[key] == i and key not in _map]
+        _map.update(izip(new, count(len(keys))))
+        keys.extend(new)
+        self.__live = None  # rebuilt lazily if needed
+
+    def __ior__(self, iterable):
+        self.__extend(iterable)
+        return self
 
     def union(self, s):
         check_deterministic(s)
         n = self.copy()
-        for elem in s:
-            if elem not in n:
-                n.add(elem)
+        n.__extend(s)
         return n
 
+    def intersection(self, s):
+        """ keys of self which are also in ``s``, in the order of self """
+        return self.__class__(self.__filter(s, keep=True))
+
     def intersection_update(self, s):
-        l = []
-        for elem in self:
-            if elem not in s:
-                l.append(elem)
-        for elem in l:
-            self.remove(elem)
+        self.__setstate__(self.__filter(s, keep=True))
         return self
 
+    def difference(self, s):
+        check_deterministic(s)
+        return self.__class__(self.__filter(s, keep=False))
+
     def difference_update(self, s):
         check_deterministic(s)
-        for elem in s:
-            if elem in self:
-                self.remove(elem)
+        if isinstance(s, Sized) and 4 * len(s) < len(self):  # few keys to remove, tombstones are cheaper
+            for elem in s:
+                self.discard(elem)
+        else:
+            self.__setstate__(self.__filter(s, keep=False))
         return self
 
+    def __filter(self, s, keep):
+        """ list of keys of self which are (keep=True) or are not (keep=False) in ``s`` """
+        if not isinstance(s, (Set, Mapping)):
+            s = set(s)
+        if keep:
+            return [key for key in self if key in s]
+        return [key for key in self if key not in s]
+
+    def __getitem__(self, index):
+        """ positional access like for lists (O(log n) if keys were discarded), slices return lists """
+        if len(self.__keys) == len(self.__map):  # no tombstones, positions are the true indices
+            return self.__keys[index]
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self.__map)
+        if not 0 <= index < len(self.__map):
+            raise IndexError("%s index out of range" % self.__class__.__name__)
+        return self.__keys[self.__live_slots().find(index)]
+
+    def index(self, key):
+        """ position of ``key`` like ``list.index`` (O(log n) if keys were discarded) """
+        try:
+            position = self.__map[key]
+        except KeyError:
+            raise ValueError("%r is not in %s" % (key, self.__class__.__name__))
+        if len(self.__keys) == len(self.__map):
+            return position
+        return self.__live_slots().count_before(position)
+
+    def __live_slots(self):
+        """ ``_LiveSlots`` of self.__keys, built lazily and afterwards kept up to date until the next compaction """
+        if self.__live is None:
+            self.__live = _LiveSlots([key is not _deleted for key in self.__keys])
+        return self.__live
+
     def copy(self):
-        n = OrderedSet()
-        n.update(self)
+        n = self.__class__()
+        n.__setstate__(list(self))
         return n
 
     def discard(self, key):
-        # Remove an existing item using self.__map to find the link which is
-        # then removed by updating the links in the predecessor and successors.
+        # Remove an existing item by replacing its slot with a tombstone
         if key in self.__map:
-            link = self.__map.pop(key)
-            link.prev().next = link.next
-            link.next().prev = link.prev
+            position = self.__map.pop(key)
+            self.__keys[position] = _deleted
+            if self.__live is not None:
+                self.__live.remove(position)
+            self.__trim()
+
+    def __trim(self):
+        """ drops trailing tombstones and compacts the list if it consists mainly of tombstones """
+        keys = self.__keys
+        while keys and keys[-1] is _deleted:
+            keys.pop()
+        self.__head = min(self.__head, len(keys))
+        if len(keys) > 2 * len(self.__map) + 8:
+            self.__compact()
+
+    def __compact(self):
+        self.__keys = keys = [key for key in self.__keys if key is not _deleted]
+        self.__map = dict(izip(keys, count()))
+        self.__head = 0
+        self.__live = None
 
     def __iter__(self):
-        # Traverse the linked list in order.
-        root = self.__root
-        curr = root.next()
-        while curr is not root:
-            yield curr.key
-            curr = curr.next()
+        # Traverse the list in order, skipping tombstones.
+        for key in islice(self.__keys, self.__head, None):
+            if key is not _deleted:
+                yield key
 
     def __reversed__(self):
-        # Traverse the linked list in reverse order.
-        root = self.__root
-        curr = root.prev()
-        while curr is not root:
-            yield curr.key
-            curr = curr.prev()
+        # Traverse the list in reverse order, skipping tombstones.
+        for key in reversed(self.__keys):
+            if key is not _deleted:
+                yield key
 
     def pop(self, last=True):
         if not self:
             raise KeyError('set is empty')
+        keys = self.__keys
         if last:
-            key = next(reversed(self))
+            key = keys[-1]  # trailing tombstones are always trimmed
         else:
-            key = next(iter(self))
+            while keys[self.__head] is _deleted:
+                self.__head += 1
+            key = keys[self.__head]
         self.discard(key)
         return key
 
+    def __getstate__(self):
+        # plain list of keys, so that unpickling needs neither tombstones nor weakrefs
+        # (wrapped in a tuple, as an empty state would be falsy and hence not be restored by pickle protocols 0 and 1)
+        return (list(self),)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):  # pickled by the former linked-list implementation
+            root = state['_OrderedSet__root']
+            keys = []
+            curr = root.next()
+            while curr is not root:
+                keys.append(curr.key)
+                curr = curr.next()
+            state = keys
+        elif isinstance(state, tuple):
+            state, = state
+        self.__keys = keys = list(state)
+        self.__map = dict(izip(keys, count()))
+        self.__head = 0
+        self.__live = None
+
     def __repr__(self):
         if not self:
             return '%s()' % (self.__class__.__name__,)
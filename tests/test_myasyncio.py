@@ -0,0 +1,70 @@
+import asyncio
+import threading
+
+from schlichtanders.myfunctools import fmap
+
+
+async def _count(n):
+    for i in range(n):
+        await asyncio.sleep(0)
+        yield i
+
+
+async def _collect(agen):
+    return [x async for x in agen]
+
+
+def test_fmap_async_generator():
+    async def double_async(x):
+        await asyncio.sleep(0)
+        return 2 * x
+
+    mapped = fmap(lambda x, y: x + y, _count(4), y=_count(5))
+    assert asyncio.run(_collect(mapped)) == [0, 2, 4, 6]
+    mapped = fmap(double_async, _count(5), _concurrency=3)
+    assert asyncio.run(_collect(mapped)) == [0, 2, 4, 6, 8]
+
+
+def test_fmap_coroutine_and_coroutine_function():
+    async def value(x):
+        await asyncio.sleep(0)
+        return x
+
+    assert asyncio.run(fmap(lambda a, b: a * b, value(3), b=value(4))) == 12
+
+    def offset(x, offset=0):
+        return x + offset
+
+    combined = fmap(lambda a, b: (a, b), value, offset)
+    assert asyncio.iscoroutinefunction(combined)
+    assert asyncio.run(combined(1, offset=10)) == (1, 11)
+
+
+def test_async_compose_with_executor_and_kwargs():
+    from concurrent.futures import ThreadPoolExecutor
+    from schlichtanders.myasyncio import AsyncCompose, compose_async
+
+    async def fetch(x, delay=0):
+        await asyncio.sleep(delay)
+        return x, x + 1
+
+    threads = []
+
+    def add(a, b, scale=1):
+        threads.append(threading.current_thread())
+        return (a + b) * scale
+
+    def show(x):
+        return "%s" % x
+
+    composed = compose_async(add, fetch)
+    assert asyncio.run(composed(1, delay=0, scale=10)) == 30
+
+    with ThreadPoolExecutor(2) as pool:
+        pipeline = AsyncCompose(executor=pool) + show + add + fetch
+        assert pipeline.executor is pool
+        assert asyncio.run(pipeline(2, scale=3)) == "15"
+        assert threads[0] is threading.main_thread() and threads[1] is not threading.main_thread()
+        pipeline = fetch + pipeline.__class__(add, executor=pool)
+        assert pipeline.executor is pool
+        assert asyncio.run(pipeline(1, 2)) == (3, 4)
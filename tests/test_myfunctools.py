@@ -0,0 +1,385 @@
+import os
+import pickle
+import time
+from collections import OrderedDict
+from itertools import count, islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pytest
+
+from schlichtanders import myfunctools
+from schlichtanders.myfunctools import (
+    Average, Batched, Cached, Compose, DiskCache, ParallelMeanmap, ParallelSummap, RunningLogSumExp, SimulateOnline,
+    compose, content_digest, evaluate_lazy, fmap, fmappable, lazy, lift, meanexp, register_fmap, scalar, sumexp)
+
+
+def test_compose_cache_keys_ndarrays_by_content():
+    calls = []
+
+    def load(n):
+        calls.append('load')
+        return np.arange(n)
+
+    def total(x, scale=1):
+        calls.append('total')
+        return x.sum() * scale
+
+    composed = compose(total, load, cache=4)
+    assert composed(4) == 6
+    assert composed(4, scale=2) == 12  # load is cached, total gets an ndarray and a new kwarg
+    assert composed(4, scale=2) == 12  # total is cached despite its ndarray input
+    assert calls == ['load', 'total', 'total']
+    assert [c.hits for c in composed.caches] == [2, 1]
+
+
+def test_compose_concatenation_keeps_options():
+    inc = lambda x: x + 1
+    double = lambda x: x * 2
+    for composed in [Compose(inc, cache=8, profile=True) + double,
+                     double + Compose(inc, cache=8, profile=True)]:
+        assert composed.cache == 8 and composed.profile
+        composed(1)
+        composed(1)
+        assert [c.hits for c in composed.caches] == [1, 1]
+        assert composed.stage_profile is not None
+    assert not (Compose(inc, expand_tuple=False) + double).expand_tuple
+
+
+def _inc(x):
+    return x + 1
+
+
+def test_compose_can_be_pickled_after_calls():
+    composed = Compose(_inc, _inc, cache=2)
+    assert composed(1) == 3
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        restored = pickle.loads(pickle.dumps(composed, protocol))
+        assert restored(1) == 3 and restored.cache == 2
+    content_digest(composed)  # i.e. DiskCache can key it
+    pool = Pool(2)
+    try:
+        assert pool.map(composed, [1, 2]) == [3, 4]
+    finally:
+        pool.terminate()
+
+
+def test_fmap_ndarray_scalar_promotes_dtype_of_later_chunks():
+    ret = fmap(scalar(lambda x: 1 if x < 4096 else 1.5), np.arange(5000))
+    assert ret.dtype == float
+    assert ret[0] == 1 and ret[-1] == 1.5
+
+
+def test_fmap_ndarray_scalar_multiple_outputs():
+    quotient, remainder = fmap(scalar(lambda x: divmod(x, 3)), np.arange(10).reshape(2, 5), _chunksize=3)
+    assert np.array_equal(quotient, np.arange(10).reshape(2, 5) // 3)
+    assert np.array_equal(remainder, np.arange(10).reshape(2, 5) % 3)
+
+
+def _global_rng_mean():
+    return np.random.randn(100).mean()
+
+
+def _random_state_mean(random_state):
+    return random_state.randn(100).mean()
+
+
+def test_average_seeded_repetitions_are_reproducible():
+    np.random.seed(0)
+    before = np.random.get_state()[1].copy()
+    serial = Average(8, seed=1)(_global_rng_mean)
+    assert np.array_equal(np.random.get_state()[1], before)  # caller's global state is restored
+    pool = Pool(2)
+    try:
+        assert Average(8, seed=1, executor=pool)(_global_rng_mean) == serial
+    finally:
+        pool.terminate()
+
+    threads = ThreadPool(4)
+    try:
+        with pytest.raises(ValueError):
+            Average(8, seed=1, executor=threads)(_global_rng_mean)
+        assert Average(8, executor=threads)(lambda x: x, 3.0) == 3.0  # no seed, no random_state needed
+        np.random.seed(0)
+        unseeded = Average(8, executor=threads)(_global_rng_mean)
+        np.random.seed(0)
+        assert unseeded == pytest.approx(np.mean([_global_rng_mean() for _ in range(8)]))  # global state untouched
+        assert (Average(8, seed=1, executor=threads)(_random_state_mean) ==
+                Average(8, seed=1)(_random_state_mean))
+    finally:
+        threads.terminate()
+
+
+SCALE = 2
+
+
+def _scaled(x):
+    return x * SCALE
+
+
+def _factorial(n):
+    return 1 if n <= 1 else n * _factorial(n - 1)
+
+
+def test_content_digest_of_functions_includes_their_state():
+    def make(k):
+        return lambda x: x * k
+
+    def with_default(x, k=2):
+        return x * k
+
+    assert content_digest(make(2)) == content_digest(make(2))
+    assert content_digest(make(2)) != content_digest(make(100))
+    before = content_digest(with_default)
+    with_default.__defaults__ = (3,)
+    assert content_digest(with_default) != before
+
+    global SCALE
+    before = content_digest(_scaled)
+    SCALE = 3
+    try:
+        assert content_digest(_scaled) != before
+    finally:
+        SCALE = 2
+    assert content_digest(_factorial) == content_digest(_factorial)  # recursion terminates
+
+
+def test_content_digest_of_functions_includes_names():
+    assert content_digest(lambda x: x.sum()) != content_digest(lambda x: x.mean())
+    assert content_digest(lambda x: np.sin(x)) != content_digest(lambda x: np.cos(x))
+    assert content_digest(lambda a, b: a) != content_digest(lambda b, a: b)  # differ when called by keyword
+    assert content_digest(lambda x: x.sum()) == content_digest(lambda x: x.sum())
+
+
+def test_disk_cache_distinguishes_closures(tmpdir):
+    def make(k):
+        return lambda x: x * k
+    cache = DiskCache(str(tmpdir))
+    assert lift(make(2), cache)(3) == 6
+    assert lift(make(100), cache)(3) == 300
+    assert lift(make(2), cache)(3) == 6
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_register_fmap_for_subtypes_of_registered_types():
+    def fmap_ordered_dict(func, context, _inplace=False):
+        return OrderedDict((k, func(v)) for k, v in reversed(list(context.items())))
+
+    def fmap_tuple(func, *contexts, **kwargs):
+        return tuple(map(func, *contexts))
+
+    register_fmap(OrderedDict, fmap_ordered_dict)
+    register_fmap(tuple, fmap_tuple)
+    try:
+        inc = lambda x: x + 1
+        assert list(fmap(inc, OrderedDict([('a', 1), ('b', 2)])).items()) == [('b', 3), ('a', 2)]
+        assert fmap(inc, (1, 2)) == (2, 3)
+        assert fmap(inc, {'a': 1}) == {'a': 2}  # less specific types keep their implementation
+        assert fmap(inc, [1, 2]) == [2, 3]
+    finally:
+        del fmappable[OrderedDict], fmappable[tuple]
+        fmap.cache_clear()
+
+
+def test_sumexp_of_integers_is_computed_in_float64():
+    for dtype in (np.int8, np.uint8, np.int16, bool):
+        assert sumexp(np.zeros(5000, dtype)) == pytest.approx(np.log(5000), abs=1e-12)
+        assert meanexp(np.zeros(5000, dtype)) == pytest.approx(0, abs=1e-12)
+    running = RunningLogSumExp()
+    running.add_many(np.zeros(5000, np.int8))
+    assert running.result() == pytest.approx(np.log(5000), abs=1e-12)
+    assert sumexp(np.zeros(3, np.float32)).dtype == np.float32
+
+
+def test_sumexp_of_unstackable_values_rejects_other_axes():
+    values = [np.zeros((2, 1)), np.zeros(3)]  # broadcast elementwise
+    assert np.allclose(sumexp(values), np.full((2, 3), np.log(2)))
+    with pytest.raises(ValueError):
+        sumexp(values, axis=1)
+    with pytest.raises(ValueError):
+        meanexp(values, axis=1)
+
+
+def test_disk_cache_returns_arrays_alike_on_misses_and_hits(tmpdir):
+    cache = DiskCache(str(tmpdir))
+    missed = cache(np.arange, 5)
+    hit = cache(np.arange, 5)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert type(missed) is type(hit) is np.memmap
+    assert not missed.flags.writeable and not hit.flags.writeable
+    assert np.array_equal(missed, np.arange(5))
+
+    cache = DiskCache(str(tmpdir.join("in_memory")), mmap_mode=None)
+    assert cache(np.arange, 5).flags.writeable and cache(np.arange, 5).flags.writeable
+
+
+def test_disk_cache_keeps_entry_stored_concurrently(tmpdir, monkeypatch):
+    cache = DiskCache(str(tmpdir))
+
+    def rename_fails_if_exists(src, dst):  # like on Windows
+        raise OSError("exists")
+    monkeypatch.setattr(os, "rename", rename_fails_if_exists)
+    assert cache(lambda x: x + 1, 1) == 2
+    assert not [name for name in os.listdir(str(tmpdir)) if name.endswith(".tmp")]
+
+
+def test_batched_coalesces_concurrent_calls_in_order():
+    batch_sizes = []
+
+    def square_all(xs):
+        batch_sizes.append(len(xs))
+        return [x * x for x in xs]
+
+    square = Batched(square_all, max_batch=8, max_wait_ms=50)
+    threads = ThreadPool(16)
+    try:
+        assert threads.map(square, range(100), chunksize=1) == [x * x for x in range(100)]
+        assert sum(batch_sizes) == 100 and max(batch_sizes) <= 8
+        assert len(batch_sizes) < 100  # i.e. calls were actually batched
+
+        def fail(xs):
+            raise KeyError("boom")
+        failing = Batched(fail, max_wait_ms=50)
+        results = [threads.apply_async(failing, (i,)) for i in range(4)]
+        for r in results:
+            with pytest.raises(KeyError):
+                r.get(5)
+        with pytest.raises(ValueError):  # wrong number of results
+            Batched(lambda xs: xs[:-1])(1)
+    finally:
+        threads.terminate()
+
+
+def test_fmap_with_executor_consumes_infinite_generators_lazily():
+    consumed = []
+
+    def naturals():
+        for i in count():
+            consumed.append(i)
+            yield i
+
+    threads = ThreadPool(2)
+    try:
+        mapped = fmap(_inc, naturals(), _executor=threads, _chunksize=3)
+        assert list(islice(mapped, 5)) == [1, 2, 3, 4, 5]
+        assert len(consumed) <= 2 * 2 * 3 + 3  # at most two chunks per worker in flight, plus the one consumed
+
+        assert fmap(lambda x, y: x * y, [1, 2, 3], y=[4, 5, 6], _executor=threads) == [4, 10, 18]
+        assert fmap(_inc, {'a': 1, 'b': 2}, _executor=threads) == {'a': 2, 'b': 3}
+    finally:
+        threads.terminate()
+    pool = Pool(2)
+    try:
+        assert fmap(_inc, list(range(10)), _executor=pool, _chunksize=4) == list(range(1, 11))
+    finally:
+        pool.terminate()
+
+
+def test_simulate_online_evicts_least_recently_used_states():
+    online = SimulateOnline(hash_by=SimulateOnline.hash_by_id, maxsize=2)
+    first = lambda x: x
+    a, b, c = [1, 2, 3], [10, 20, 30], [100, 200, 300]
+    assert [online(first, a), online(first, b), online(first, a)] == [1, 10, 2]
+    assert online(first, c) == 100  # evicts b, as a was used more recently
+    assert list(online.states) == [(id(a),), (id(c),)]
+    assert online(first, a) == 3
+    assert online(first, b) == 10  # starts over
+    assert online(first, a) == 1  # cycles
+
+
+def test_simulate_online_prefetches_next_args_in_order():
+    fetched = []
+
+    def numbers():
+        for i in range(3):
+            fetched.append(i)
+            yield i
+
+    class Numbers(object):  # iterable anew for cycling
+        def __iter__(self):
+            return numbers()
+
+    online = SimulateOnline(prefetch=True)
+    results = [online(lambda x: x, Numbers())]
+    deadline = time.time() + 5
+    while len(fetched) < 2 and time.time() < deadline:  # the next args are fetched in the background
+        time.sleep(0.001)
+    assert fetched == [0, 1]
+    results += [online(lambda x: x, Numbers()) for _ in range(4)]
+    assert results == [0, 1, 2, 0, 1]
+
+
+def _outer(x, y):
+    return np.outer([x, 1], [y, 1])
+
+
+def test_parallel_summap_matches_serial_sums():
+    xs, ys = list(range(20)), list(range(20, 40))
+    expected = sum(_outer(x, y) for x, y in zip(xs, ys))
+    assert np.array_equal(ParallelSummap()(_outer, xs, ys), expected)
+    pool = Pool(2)
+    try:
+        assert np.array_equal(ParallelSummap(pool, chunksize=4)(_outer, xs, ys), expected)
+        assert np.allclose(ParallelMeanmap(pool, chunksize=3)(_outer, xs, ys), expected / 20.)
+    finally:
+        pool.terminate()
+
+    threads = ThreadPool(2)
+    try:  # generators work as well
+        summap = ParallelSummap(threads, chunksize=2, prefetch=2)
+        assert summap(lambda x: 0.1 * x, (i for i in range(1001))) == pytest.approx(0.1 * sum(range(1001)))
+    finally:
+        threads.terminate()
+
+
+def test_cached_expires_and_evicts_least_recently_used(monkeypatch):
+    now = [0.]
+    monkeypatch.setattr(myfunctools, "default_timer", lambda: now[0])
+    calls = []
+
+    def double(x):
+        calls.append(x)
+        return 2 * x
+
+    cache = Cached(maxsize=2, ttl=10)
+    assert [cache(double, 1), cache(double, 2), cache(double, 1)] == [2, 4, 2]
+    assert (cache.hits, cache.misses) == (1, 2)
+    cache(double, 3)  # evicts 2, as 1 was used more recently
+    cache(double, 1)
+    cache(double, 2)
+    assert calls == [1, 2, 3, 2]
+    assert (cache.hits, cache.misses) == (2, 4)
+
+    now[0] = 11.  # 1 was cached at time 0, i.e. expired
+    assert cache(double, 1) == 2
+    assert calls == [1, 2, 3, 2, 1]
+    assert cache(np.sum, np.arange(3)) == cache(np.sum, np.arange(3))  # ndarrays are keyed by content
+    assert (cache.hits, cache.misses) == (3, 6)
+
+
+def test_lazy_fmaps_are_fused_and_shared():
+    log = []
+
+    def traced(name, func):
+        def call(*args):
+            log.append((name,) + args)
+            return func(*args)
+        return call
+
+    inc, double = traced('inc', _inc), traced('double', lambda x: 2 * x)
+    add = traced('add', lambda x, y: x + y)
+    xs = lazy(range(3))
+    ys = fmap(add, fmap(double, fmap(inc, xs)), fmap(inc, xs))  # the second fmap(inc, xs) equals the first
+    assert log == []  # nothing computed yet
+    assert ys.compute() == [3, 6, 9]
+    assert log == [  # element by element, inc once per element
+        ('inc', 0), ('double', 1), ('add', 2, 1),
+        ('inc', 1), ('double', 2), ('add', 4, 2),
+        ('inc', 2), ('double', 3), ('add', 6, 3),
+    ]
+
+    del log[:]
+    incremented = fmap(inc, [1, 2], _lazy=True)
+    assert list(evaluate_lazy(incremented, fmap(double, incremented))) == [(2, 4), (3, 6)]
+    assert [entry[0] for entry in log] == ['inc', 'double', 'inc', 'double']
@@ -0,0 +1,68 @@
+import pickle
+import random
+import sys
+
+import pytest
+
+if sys.version_info[0] > 2:
+    pytest.skip("myobjects supports python 2 only", allow_module_level=True)
+
+from schlichtanders.myobjects import NestedNamespace, OrderedSet
+
+
+def test_orderedset_pop_first_then_add():
+    s = OrderedSet([1, 2])
+    s.pop(last=False)
+    s.pop(last=False)
+    s.add(3)
+    assert list(s) == [3]
+    assert len(s) == 1
+
+
+def test_orderedset_pickle_empty():
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        s = pickle.loads(pickle.dumps(OrderedSet(), protocol))
+        s.add(1)
+        assert list(s) == [1]
+        assert list(pickle.loads(pickle.dumps(OrderedSet([3, 1, 2]), protocol))) == [3, 1, 2]
+
+
+def test_orderedset_positional_access_matches_list():
+    rng = random.Random(0)
+    s = OrderedSet()
+    reference = []
+    for _ in range(3000):
+        op = rng.random()
+        if op < 0.45:
+            key = rng.randint(0, 300)
+            s.add(key)
+            if key not in reference:
+                reference.append(key)
+        elif op < 0.8 and reference:
+            key = rng.choice(reference)
+            s.discard(key)
+            reference.remove(key)
+        elif op < 0.85 and reference:
+            last = rng.random() < 0.5
+            assert s.pop(last=last) == reference.pop(-1 if last else 0)
+        if reference:
+            i = rng.randrange(-len(reference), len(reference))
+            assert s[i] == reference[i]
+            key = rng.choice(reference)
+            assert s.index(key) == reference.index(key)
+        assert list(s) == reference
+        assert s[1:3] == reference[1:3]
+
+
+def test_nestednamespace_freeze_leaves_nested_namespaces_unfrozen():
+    class B(object):
+        y = 2
+    b = B()
+    inner = NestedNamespace(b)
+    outer = NestedNamespace(inner)
+    outer.freeze()
+    b.y = 5
+    assert outer.y == 2
+    outer.unfreeze()
+    assert inner.y == 5
+    assert outer.y == 5